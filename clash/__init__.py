@@ -1 +1,2 @@
-from .clash import Clash
\ No newline at end of file
+from .clash import Clash
+from .pool import ClashPool
\ No newline at end of file
@@ -4,40 +4,60 @@ import logging
 import os
 import shutil
 import subprocess
-from urllib.parse import urljoin
-
-import aiohttp
-import appdirs
-import yaml
+from urllib.parse import quote, urljoin
 
 import config
 import utils.logging
+from utils.lazy import cached_classproperty
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
 
 
 class Clash:
-    CONFIG_DIR = os.path.join(appdirs.user_data_dir(config.APP_NAME), 'clash')
-    BIN_PATH = os.path.join(CONFIG_DIR, 'clash')
-    MAXMIND_DB_PATH = os.path.join(CONFIG_DIR, 'Country.mmdb')
+    @cached_classproperty
+    def CONFIG_DIR(cls) -> str:
+        return config.clash_dir()
+
+    @cached_classproperty
+    def BIN_PATH(cls) -> str:
+        return os.path.join(cls.CONFIG_DIR, 'clash')
+
+    @cached_classproperty
+    def MAXMIND_DB_PATH(cls) -> str:
+        return config.maxmind_db_path()
 
     def __init__(self, config: dict, id_: str) -> None:
         self.id = id_
         self.config = config
+        self.reloads = 0
+        '''number of config reloads since started'''
         self._process: subprocess.Popen
         self._logger = utils.logging.IDAdapter(logger, {'id': self.id})
+        self._config_dir: str
+
+    @property
+    def _config_path(self):
+        return os.path.join(self._config_dir, 'config.yaml')
+
+    def _dump_config(self):
+        import yaml
+
+        with open(self._config_path, 'w', encoding='utf-8') as fs:
+            yaml.safe_dump(self.config, fs, allow_unicode=True)
 
     def start(self):
         """Start clash."""
+        import appdirs
+
         self._logger.info('Starting clash')
         config_dir = os.path.join(appdirs.user_cache_dir(config.APP_NAME), self.id)
+        self._config_dir = config_dir
         shutil.rmtree(config_dir, ignore_errors=True)
         os.makedirs(config_dir, exist_ok=True)
-        config_path = os.path.join(config_dir, 'config.yaml')
         os.link(self.MAXMIND_DB_PATH, os.path.join(config_dir, 'Country.mmdb'))
-        with open(config_path, 'w', encoding='utf-8') as fs:
-            yaml.safe_dump(self.config, fs, allow_unicode=True)
+        self._dump_config()
         self._process = subprocess.Popen([self.BIN_PATH, '-d', config_dir])
+        self.reloads = 0
         self._logger.debug(
             'Clash started, pid=%d port=%d controller=%s working_dir=%s',
             self._process.pid,
@@ -46,6 +66,80 @@ class Clash:
             config_dir,
         )
 
+    def stop(self, timeout=5.0):
+        """Stop clash, killing it if it has not exited after `timeout` seconds.
+
+        Blocking, run it in a thread from the event loop.
+        """
+        if self.poll() is None:
+            self._logger.debug('Stopping clash, pid=%d', self._process.pid)
+            self._process.terminate()
+            try:
+                self._process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self._logger.warning('Clash did not exit, killing it')
+                self._process.kill()
+                self._process.wait()
+
+    async def reload(self, config: dict):
+        """Replace the running config without restarting clash.
+
+        `mixed-port` and `external-controller` should be kept unchanged.
+        """
+        import aiohttp
+
+        self.config = config
+        self._dump_config()
+        restful_url = urljoin(self.external_controller, 'configs?force=true')
+        payload = {'path': os.path.abspath(self._config_path)}
+        async with aiohttp.ClientSession() as session:
+            async with session.put(restful_url, data=json.dumps(payload)) as resp:
+                if resp.status != 204:
+                    raise RuntimeError(
+                        f'failed to reload clash config, code: {resp.status}, '
+                        f'text: {await resp.text()}'
+                    )
+        self.reloads += 1
+        self._logger.debug('Clash config reloaded, reloads=%d', self.reloads)
+
+    async def healthy(self, timeout=5.0) -> bool:
+        """Whether clash is running and its controller answers."""
+        import aiohttp
+
+        if self.poll() is not None:
+            return False
+        restful_url = urljoin(self.external_controller, 'version')
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        try:
+            async with aiohttp.ClientSession(timeout=client_timeout) as session:
+                async with session.get(restful_url) as resp:
+                    return resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def wait_ready(self, timeout=10.0, interval=0.1) -> bool:
+        """Wait until the controller answers."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            if await self.healthy(interval * 10):
+                return True
+            if self.poll() is not None:
+                break
+            await asyncio.sleep(interval)
+        return False
+
+    def rss(self) -> int:
+        """Resident memory of the clash process in bytes, 0 if unknown."""
+        try:
+            with open(f'/proc/{self._process.pid}/status', 'r') as fs:
+                for line in fs:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, AttributeError):
+            pass
+        return 0
+
     def poll(self):
         """Poll clash."""
         return self._process.poll()
@@ -55,40 +149,61 @@ class Clash:
         return f'http://{self.config["external-controller"]}'
 
     async def ping(
-        self, name: str, timeout=2000, url='http://www.gstatic.com/generate_204'
+        self,
+        name: str,
+        timeout=2000,
+        url='http://www.gstatic.com/generate_204',
+        logger_: logging.LoggerAdapter | None = None,
     ):
         """Ping a proxy.
 
+        Args
+        ---
+        logger_: logs the ping, e.g. under the id of the subscription being
+        probed, default to the logger of this clash
+
         Return
         ---
         parsed json data
         """
-        restful_url = urljoin(
-            self.external_controller, f'proxies/{name}/delay?{timeout=}&url={url}'
-        )
+        import aiohttp
+
+        logger_ = logger_ or self._logger
+        query = f'{timeout=}&url={quote(url, safe="")}'
+        restful_url = urljoin(self.external_controller, f'proxies/{name}/delay?{query}')
         client_timeout = aiohttp.ClientTimeout(total=max(timeout / 1000 + 1, 5))
         async with aiohttp.ClientSession(timeout=client_timeout) as session:
             try:
                 async with session.get(restful_url) as resp:
-                    self._logger.debug('Start  ping %s', name)
+                    logger_.debug('Start  ping %s', name, extra={'proxy': name})
                     ret = await resp.json()
-                    self._logger.debug('Finish ping %s', name)
+                    logger_.debug('Finish ping %s', name, extra={'proxy': name})
                     return ret
             except asyncio.TimeoutError:
-                self._logger.warning('Failed to ping %s', name)
+                logger_.warning('Failed to ping %s', name, extra={'proxy': name})
                 return {'message': 'timeout'}
 
     def __del__(self):
         self._process.terminate()
 
-    async def switch(self, group: str, name: str):
-        """Switch to a proxy."""
+    async def switch(
+        self, group: str, name: str, logger_: logging.LoggerAdapter | None = None
+    ):
+        """Switch to a proxy.
+
+        Args
+        ---
+        logger_: default to the logger of this clash
+        """
+        import aiohttp
+
+        logger_ = logger_ or self._logger
         restful_url = urljoin(self.external_controller, f'proxies/{group}')
         payload = {'name': name}
         async with aiohttp.ClientSession() as session:
             async with session.put(restful_url, data=json.dumps(payload)) as resp:
                 if resp.status != 204:
-                    self._logger.warning(
+                    logger_.warning(
                         'Failed to switch to proxy %s, code: %d, text: %s',
                         name,
                         resp.status,
@@ -100,3 +215,7 @@ class Clash:
     @property
     def port(self) -> int:
         return self.config['mixed-port']
+
+    @property
+    def controller_port(self) -> int:
+        return int(self.config['external-controller'].rsplit(':', 1)[-1])
@@ -0,0 +1,96 @@
+"""Pool of long-lived clash workers."""
+import asyncio
+import contextlib
+import logging
+from typing import Iterator
+
+import config
+from clash.clash import Clash
+from clash.utils.common import build_simple_config
+
+logger = logging.getLogger(config.APP_NAME).getChild(__name__)
+
+
+class ClashPool:
+    """Clash workers which load new proxy sets by hot config reload.
+
+    A worker is recycled, i.e. restarted, when it fails the health check or a
+    config reload, has been reloaded `max_reloads` times or its memory exceeds
+    `max_rss` bytes.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        port_picker: Iterator[int],
+        max_reloads=100,
+        max_rss=0,
+    ) -> None:
+        """
+        Args
+        ---
+        size: maximum number of workers
+        port_picker: yields free tcp ports for workers
+        max_reloads: 0 to never recycle by reload count
+        max_rss: 0 to never recycle by memory
+        """
+        self._size = size
+        self._port_picker = port_picker
+        self._max_reloads = max_reloads
+        self._max_rss = max_rss
+        self._workers: list[Clash] = []
+        self._idle: asyncio.Queue[Clash] = asyncio.Queue()
+
+    async def _spawn(self) -> Clash:
+        port, controller_port = next(self._port_picker), next(self._port_picker)
+        conf = build_simple_config(port, controller_port, [])
+        worker = Clash(conf, f'worker-{len(self._workers)}')
+        self._workers.append(worker)
+        worker.start()
+        if not await worker.wait_ready():
+            logger.warning('Clash worker %s is not ready', worker.id)
+        return worker
+
+    async def _recycle_if_needed(self, worker: Clash):
+        reason = ''
+        if not await worker.healthy():
+            reason = 'unhealthy'
+        elif self._max_reloads and worker.reloads >= self._max_reloads:
+            reason = f'{worker.reloads} reloads'
+        elif self._max_rss and worker.rss() > self._max_rss:
+            reason = f'rss {worker.rss() >> 20} MiB'
+        if not reason:
+            return
+        logger.info('Recycling clash worker %s, %s', worker.id, reason)
+        await asyncio.to_thread(worker.stop)
+        worker.start()
+        if not await worker.wait_ready():
+            logger.warning('Clash worker %s is not ready', worker.id)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, proxies: list[dict]):
+        """Get a worker running `proxies`, it is returned to the pool on exit."""
+        if self._idle.empty() and len(self._workers) < self._size:
+            worker = await self._spawn()
+        else:
+            worker = await self._idle.get()
+            await self._recycle_if_needed(worker)
+        try:
+            conf = build_simple_config(worker.port, worker.controller_port, proxies)
+            try:
+                await worker.reload(conf)
+            except Exception:
+                # The config may be stale, the next acquire restarts the worker
+                await asyncio.to_thread(worker.stop)
+                raise
+            yield worker
+        finally:
+            self._idle.put_nowait(worker)
+
+    async def close(self):
+        """Stop all workers."""
+        await asyncio.gather(
+            *[asyncio.to_thread(worker.stop) for worker in self._workers]
+        )
+        self._workers.clear()
+        self._idle = asyncio.Queue()
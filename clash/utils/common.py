@@ -1,17 +1,30 @@
-import gzip
-import io
+import asyncio
+import hashlib
 import logging
 import os
 import platform
+import shutil
 import stat
-import zipfile
-
-import requests
+import time
+from urllib.parse import urlparse
 
 import config
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
 
+# fmt: off
+CLASH_BIN_URLS = {
+    ('Windows', 'AMD64'):   'https://github.com/AquanJSW/clashpremium-core-binaries/raw/main/clashpremium-windows-amd64.exe',
+    ('Linux',   'x86_64'):  'https://github.com/AquanJSW/clashpremium-core-binaries/raw/main/clashpremium-linux-amd64',
+    ('Linux',   'aarch64'): 'https://github.com/AquanJSW/clashpremium-core-binaries/raw/main/clashpremium-linux-armv8'
+}
+# fmt: on
+MAXMIND_DB_URL = (
+    'https://github.com/Dreamacro/maxmind-geoip/releases/download/20230812/Country.mmdb'
+)
+
+_CHUNK_SIZE = 1 << 16
+
 
 def build_simple_config(port, controller_port, proxies: list[dict]):
     """Build simple clash config."""
@@ -25,36 +38,159 @@ def build_simple_config(port, controller_port, proxies: list[dict]):
     }
 
 
-def download_clash_bin(
-    filepath,
-    timeout=10,
-):
-    """Download clash binary."""
-    # fmt: off
-    URLS = {
-        ('Windows', 'AMD64'):   'https://github.com/AquanJSW/clashpremium-core-binaries/raw/main/clashpremium-windows-amd64.exe',
-        ('Linux',   'x86_64'):  'https://github.com/AquanJSW/clashpremium-core-binaries/raw/main/clashpremium-linux-amd64',
-        ('Linux',   'aarch64'): 'https://github.com/AquanJSW/clashpremium-core-binaries/raw/main/clashpremium-linux-armv8'
-    }
-    # fmt: on
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    logger.info('downloading clash binary')
-    query = (platform.system(), platform.machine())
-    assert query in URLS, f'unsupported platform: {query}'
-    raw = requests.get(URLS[query], timeout=timeout, allow_redirects=True).content
-    with open(filepath, 'wb') as fs:
-        fs.write(raw)
-    # chmod +x
-    os.chmod(filepath, os.stat(filepath).st_mode | stat.S_IEXEC)
-
-
-def download_maxmind_db(
-    filepath,
-    url='https://github.com/Dreamacro/maxmind-geoip/releases/download/20230812/Country.mmdb',
-    timeout=10,
+def _sha256(filepath: str) -> str:
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as fs:
+        while chunk := fs.read(_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _is_verified(filepath: str, sha256: str) -> bool:
+    """Whether `filepath` matches its recorded digest and `sha256` if given."""
+    try:
+        with open(f'{filepath}.sha256', 'r', encoding='utf-8') as fs:
+            recorded = fs.read().strip()
+        actual = _sha256(filepath)
+    except OSError:
+        return False
+    return actual == recorded and (not sha256 or actual == sha256.lower())
+
+
+def _local_path(url: str) -> str:
+    """Local path of a `file://` URL or a plain path, empty for remote URLs."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        from urllib.request import url2pathname
+
+        return url2pathname(parsed.path)
+    if parsed.scheme in ('http', 'https'):
+        return ''
+    return url
+
+
+def _save_validator(headers, validator_path: str):
+    """Record the `If-Range` validator of a response, to resume it later."""
+    # If-Range only accepts strong ETags
+    validator = headers.get('ETag', '')
+    if not validator or validator.startswith('W/'):
+        validator = headers.get('Last-Modified', '')
+    if validator:
+        with open(validator_path, 'w', encoding='utf-8') as fs:
+            fs.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+
+async def _fetch(url: str, part_path: str, timeout: float):
+    """Download `url` into `part_path`, resuming a previous partial download."""
+    import aiohttp
+
+    source = _local_path(url)
+    if source:
+        await asyncio.to_thread(shutil.copyfile, source, part_path)
+        return
+    validator_path = f'{part_path}.validator'
+    offset = 0
+    headers = {}
+    if os.path.exists(part_path) and os.path.exists(validator_path):
+        with open(validator_path, 'r', encoding='utf-8') as fs:
+            validator = fs.read()
+        offset = os.path.getsize(part_path)
+        # The server sends the whole file if it changed since the partial one
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+    client_timeout = aiohttp.ClientTimeout(total=None, sock_read=timeout)
+    async with aiohttp.ClientSession(
+        timeout=client_timeout, trust_env=True
+    ) as session:
+        async with session.get(url, headers=headers, allow_redirects=True) as resp:
+            if resp.status == 416:
+                # The partial download does not fit the file, start over
+                os.remove(part_path)
+                return await _fetch(url, part_path, timeout)
+            resp.raise_for_status()
+            if resp.status != 206:
+                offset = 0
+                _save_validator(resp.headers, validator_path)
+            with open(part_path, 'ab' if offset else 'wb') as fs:
+                async for chunk in resp.content.iter_chunked(_CHUNK_SIZE):
+                    fs.write(chunk)
+
+
+async def bootstrap(
+    filepath: str,
+    url: str,
+    sha256='',
+    max_age=0.0,
+    timeout=30.0,
+    executable=False,
 ):
+    """Make sure a verified copy of `url` is at `filepath`.
+
+    The file is streamed into `<filepath>.part`, checked against `sha256` if
+    given, then atomically renamed into place and its digest recorded in
+    `<filepath>.sha256`. A file not matching its recorded digest is never used.
+
+    Args
+    ---
+    url: remote URL, `file://` URL or local path of a mirror
+    sha256: optional expected hex digest
+    max_age: refresh the file after this many seconds, 0 to never refresh
+    timeout: seconds without receiving data before giving up
+    """
+    import aiohttp
+
+    name = os.path.basename(filepath)
+    cached = await asyncio.to_thread(_is_verified, filepath, sha256)
+    if cached:
+        age = time.time() - os.path.getmtime(filepath)
+        if not max_age or age < max_age:
+            logger.info('Using cached %s', name)
+            logger.debug(filepath)
+            return filepath
+        logger.info('Refreshing %s, %d hours old', name, age // 3600)
+    else:
+        logger.info('Downloading %s', name)
+
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    logger.info('downloading maxmind db')
-    raw = requests.get(url, timeout=timeout).content
-    with open(filepath, 'wb') as fs:
-        fs.write(raw)
+    part_path = f'{filepath}.part'
+    try:
+        await _fetch(url, part_path, timeout)
+        digest = await asyncio.to_thread(_sha256, part_path)
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+        if not cached:
+            raise
+        logger.warning('Failed to refresh %s, using cached one', name, exc_info=True)
+        return filepath
+    if sha256 and digest != sha256.lower():
+        os.remove(part_path)
+        if cached:
+            logger.warning('Checksum mismatch for %s, using cached one', name)
+            return filepath
+        raise ValueError(f'checksum mismatch for {url}: {digest}')
+    if executable:
+        os.chmod(part_path, os.stat(part_path).st_mode | stat.S_IEXEC)
+    os.replace(part_path, filepath)
+    if os.path.exists(f'{part_path}.validator'):
+        os.remove(f'{part_path}.validator')
+    with open(f'{filepath}.sha256', 'w', encoding='utf-8') as fs:
+        fs.write(digest)
+    logger.debug('%s sha256=%s', filepath, digest)
+    return filepath
+
+
+async def download_clash_bin(filepath, url='', sha256='', max_age=0.0):
+    """Download clash binary."""
+    if not url:
+        query = (platform.system(), platform.machine())
+        assert query in CLASH_BIN_URLS, f'unsupported platform: {query}'
+        url = CLASH_BIN_URLS[query]
+    return await bootstrap(filepath, url, sha256, max_age, executable=True)
+
+
+async def download_maxmind_db(filepath, url='', sha256='', max_age=0.0):
+    """Download maxmind db."""
+    if not url:
+        url = MAXMIND_DB_URL
+    return await bootstrap(filepath, url, sha256, max_age)
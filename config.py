@@ -1 +1,17 @@
+import os
+
 APP_NAME = 'clash-subscription-merger'
+
+
+def clash_dir() -> str:
+    """Directory of the clash binary and the maxmind db.
+
+    Kept out of the clash package, which the offline render does not load.
+    """
+    import appdirs
+
+    return os.path.join(appdirs.user_data_dir(APP_NAME), 'clash')
+
+
+def maxmind_db_path() -> str:
+    return os.path.join(clash_dir(), 'Country.mmdb')
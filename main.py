@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
 import argparse
-import asyncio
+import html
 import logging
 import os
-import sys
-from unittest.mock import Mock
+import time
+from typing import TYPE_CHECKING
 
-import yaml
-
-import clash.utils.common
 import config
-import utils.logging
-import utils.net
-from subscription.subscription import parse_subscription_config
-from template.template import Template
-from utils.telegrambot import TelegramBot
+from subscription.utils.probe import FAMILY_TARGETS, ProbeOptions, TimeoutPolicy
+from utils.telegrambot import TelegramBackend
+
+if TYPE_CHECKING:
+    # The pipeline is imported after parsing args, so -h starts fast
+    import utils.profiling
+    from subscription.subscription import Subscription
 
 logger: logging.Logger
 
@@ -24,11 +23,37 @@ class Args(argparse.Namespace):
     templates: list[str]
     outputs: list[str]
     verbose: bool
+    log_json: bool
     proxy: str
-    # cache: bool
+    resume: bool
+    global_dedupe: list[str] | None
+    clash_url: str
+    clash_sha256: str
+    mmdb_url: str
+    mmdb_sha256: str
+    max_age: float
+    ping_timeout: list[float]
+    egress_timeout: list[float]
+    timeout_percentile: float
+    timeout_margin: float
+    region_quota: int
+    probe_concurrency: int
+    probe_targets: list[str]
+    probe_families: list[str]
+    required_targets: list[str]
+    clash_workers: int
+    clash_max_reloads: int
+    clash_max_rss: int
+    proxy_providers: bool
+    rule_providers: int
+    provider_url: str
+    offline: bool
+    profile: str
+    profile_memory: bool
 
     api_key: str
     chat_id: str
+    bot_url: str
 
 
 def parse_args():
@@ -38,88 +63,357 @@ def parse_args():
     parser.add_argument('-t', '--templates', help='template files', nargs='+', required=True)
     parser.add_argument('-o', '--outputs', help='output files / directory, same name as templates if directory is provided', nargs='+', required=True)
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--log-json', action='store_true', help='log JSON lines with subscription id, stage and proxy fields')
     parser.add_argument('--proxy', default=os.environ.get('HTTPS_PROXY', ''), help='used to download subscriptions')
+    parser.add_argument('--global-dedupe', nargs='*', metavar='NAME', help='deduplicate proxies by ingress and egress IP across subscriptions, the copy of the first listed subscription is kept, unlisted ones follow in config order')
+    parser.add_argument('--resume', action='store_true', help='skip the filter stages finished by the last run on unchanged subscriptions')
+
+    output_options = parser.add_argument_group('output options')
+    output_options.add_argument('--proxy-providers', action='store_true', help='write accepted proxies once into proxy-provider files per subscription and region, referenced by templates through use')
+    output_options.add_argument('--rule-providers', type=int, default=0, metavar='MIN_RULES', help='move runs of at least MIN_RULES rules with the same target into rule-provider files shared by all templates, 0 to keep rules inline')
+    output_options.add_argument('--provider-url', default='', help='URL prefix the provider files are served from, local files are referenced if not set')
+
+    bootstrap_options = parser.add_argument_group('bootstrap options')
+    bootstrap_options.add_argument('--clash-url', default='', help='clash binary URL, file:// URL or local mirror path, default to the official build for this platform')
+    bootstrap_options.add_argument('--clash-sha256', default='', help='expected sha256 of the clash binary')
+    bootstrap_options.add_argument('--mmdb-url', default='', help='maxmind db URL, file:// URL or local mirror path, default to the country db of Dreamacro/maxmind-geoip')
+    bootstrap_options.add_argument('--mmdb-sha256', default='', help='expected sha256 of the maxmind db')
+    bootstrap_options.add_argument('--max-age', type=float, default=0, help='refresh the clash binary and maxmind db older than this many days, 0 to never refresh')
+
+    probe_options = parser.add_argument_group('probe options')
+    probe_options.add_argument('--ping-timeout', type=float, nargs=2, default=[300, 2000], metavar=('FLOOR', 'CEILING'), help='bounds of the adaptive connectivity timeout in milliseconds')
+    probe_options.add_argument('--egress-timeout', type=float, nargs=2, default=[2, 10], metavar=('FLOOR', 'CEILING'), help='bounds of the adaptive egress lookup timeout in seconds')
+    probe_options.add_argument('--timeout-percentile', type=float, default=95, help='adaptive timeouts follow this latency percentile of the subscription')
+    probe_options.add_argument('--timeout-margin', type=float, default=0.5, help='relative margin added to the latency percentile')
+    probe_options.add_argument('--region-quota', type=int, default=0, help='keep at most this many healthy proxies per egress region of a subscription, skipping the egress lookup of proxies whose ingress region has always matched a full egress region, 0 for unlimited')
+    probe_options.add_argument('--probe-concurrency', type=int, default=0, help='maximum concurrent connectivity probes per subscription, 0 for unlimited; a limit of N makes dead proxies cost about proxies / N ping timeouts instead of one')
+    probe_options.add_argument('--probe-targets', nargs='+', default=['gstatic=http://www.gstatic.com/generate_204'], metavar='NAME=URL', help='URLs every proxy is pinged against concurrently, templates select proxies reaching them through the targets key of groups')
+    probe_options.add_argument('--probe-families', nargs='+', default=[], choices=sorted(FAMILY_TARGETS), help='also probe targets only reachable over these address families, named after them')
+    probe_options.add_argument('--required-targets', nargs='+', default=[], metavar='NAME', help='targets a proxy must reach to be accepted, default to the first probe target')
+
+    clash_options = parser.add_argument_group('clash options')
+    clash_options.add_argument('--clash-workers', type=int, default=0, help='number of clash workers, 0 for one per subscription')
+    clash_options.add_argument('--clash-max-reloads', type=int, default=100, help='restart a clash worker after this many config reloads, 0 for never')
+    clash_options.add_argument('--clash-max-rss', type=int, default=0, help='restart a clash worker using more memory than this many MiB, 0 for never')
 
     bot_options = parser.add_argument_group('bot options')
     bot_options.add_argument('--api-key', help='telegram bot api key')
     bot_options.add_argument('--chat-id', help='telegram chat id')
+    bot_options.add_argument('--bot-url', default=TelegramBackend.BASE_URL, help='telegram bot api server, e.g. a local stand-in')
 
-    # dev_options = parser.add_argument_group('dev options')
-    # dev_options.add_argument('--cache', help='using cached subscriptions instead of re-downloading to speed up test', action='store_true')
+    dev_options = parser.add_argument_group('dev options')
+    dev_options.add_argument('--offline', action='store_true', help='replay cached subscriptions and the filter results of the last run, without clash or network access, to iterate on templates')
+    dev_options.add_argument('--profile', default='', metavar='DIR', help='write a cProfile dump and the wall time of each stage of every subscription per run under DIR')
+    dev_options.add_argument('--profile-memory', action='store_true', help='with --profile, also write tracemalloc snapshots before and after parsing, filtering and template fitting')
     # fmt: on
     args = parser.parse_args(namespace=Args())
+    for target in args.probe_targets:
+        if '=' not in target:
+            parser.error(f'probe target should be like NAME=URL: {target}')
+    names = [target.split('=', 1)[0] for target in args.probe_targets]
+    unknown = set(args.required_targets) - set(names) - set(args.probe_families)
+    if unknown:
+        parser.error(f'unknown required targets: {", ".join(sorted(unknown))}')
     return args
 
 
-async def _main(args: Args):
-    if args.proxy:
-        os.environ['https_proxy'] = args.proxy
-        os.environ['http_proxy'] = args.proxy
-        os.environ['HTTPS_PROXY'] = args.proxy
-        os.environ['HTTP_PROXY'] = args.proxy
-    if os.environ.get('HTTPS_PROXY', ''):
-        logger.info('Using proxy %s', os.environ['HTTPS_PROXY'])
+def prioritize(subscriptions: list['Subscription'], names: list[str]):
+    """Order subscriptions by `names` first, then by their original order."""
+    known = set(subscription.name for subscription in subscriptions)
+    for name in names:
+        if name not in known:
+            logger.warning('Subscription %s not found for deduplication', name)
+    rank = dict((name, i) for i, name in enumerate(names))
+    return sorted(
+        subscriptions, key=lambda subscription: rank.get(subscription.name, len(rank))
+    )
 
-    subscriptions = parse_subscription_config(args.subscription)
+
+async def _filter(
+    args: Args,
+    subscriptions: list['Subscription'],
+    profiler: 'utils.profiling.NullProfiler',
+):
+    """Fetch and filter subscriptions.
+
+    Return
+    ---
+    False if failed to fetch subscriptions.
+    """
+    import asyncio
+
+    import clash.utils.common
+    import utils.net
+    from subscription.subscription import deduplicate
+
+    max_age = args.max_age * 86400
+    bootstrap = asyncio.gather(
+        clash.utils.common.download_clash_bin(
+            clash.Clash.BIN_PATH, args.clash_url, args.clash_sha256, max_age
+        ),
+        clash.utils.common.download_maxmind_db(
+            clash.Clash.MAXMIND_DB_PATH, args.mmdb_url, args.mmdb_sha256, max_age
+        ),
+    )
     fetch_coros = [subscription.fetch(15) for subscription in subscriptions]
     try:
         await asyncio.gather(*fetch_coros)
     except asyncio.TimeoutError:
         logger.exception('Failed to fetch subscriptions')
-        return
+        bootstrap.cancel()
+        return False
+    await bootstrap
 
-    if os.path.exists(clash.Clash.BIN_PATH):
-        logger.info('Using cached clash binary')
-        logger.debug(clash.Clash.BIN_PATH)
-    else:
-        clash.utils.common.download_clash_bin(clash.Clash.BIN_PATH)
+    await asyncio.gather(
+        *[subscription.prefilter(args.resume) for subscription in subscriptions]
+    )
+    profiler.snapshot('parsed')
+    reader = None
+    if args.region_quota:
+        import maxminddb
 
-    if os.path.exists(clash.Clash.MAXMIND_DB_PATH):
-        logger.info('Using cached maxmind db')
-        logger.debug(clash.Clash.MAXMIND_DB_PATH)
-    else:
-        clash.utils.common.download_maxmind_db(clash.Clash.MAXMIND_DB_PATH)
+        reader = maxminddb.open_database(clash.Clash.MAXMIND_DB_PATH)
+    options = ProbeOptions(
+        TimeoutPolicy(
+            *(ms / 1000 for ms in args.ping_timeout),
+            args.timeout_percentile,
+            args.timeout_margin,
+        ),
+        TimeoutPolicy(
+            *args.egress_timeout, args.timeout_percentile, args.timeout_margin
+        ),
+        args.region_quota,
+        args.probe_concurrency,
+        dict(target.split('=', 1) for target in args.probe_targets),
+        tuple(args.required_targets),
+    )
+    for family in args.probe_families:
+        options.targets[family] = FAMILY_TARGETS[family]
+    if args.global_dedupe is not None:
+        prioritized = prioritize(subscriptions, args.global_dedupe)
+        deduplicate(prioritized, 'ingress')
 
-    picker = utils.net.get_tcp_port_picker()
-    filter_coros = [
-        subscription.filter(next(picker), next(picker))
-        for subscription in subscriptions
-    ]
-    await asyncio.gather(*filter_coros)
+    pool = clash.ClashPool(
+        args.clash_workers or len(subscriptions),
+        utils.net.get_tcp_port_picker(),
+        args.clash_max_reloads,
+        args.clash_max_rss << 20,
+    )
+    try:
+        await asyncio.gather(
+            *[
+                subscription.probe(pool, options, reader)
+                for subscription in subscriptions
+            ]
+        )
+    finally:
+        await pool.close()
+    if args.global_dedupe is not None:
+        deduplicate(prioritized, 'egress')
+    return True
 
+
+def _replay(args: Args, subscriptions: list['Subscription']):
+    """Load subscriptions and their filter results from the last run."""
+    from subscription.subscription import deduplicate
+
+    for subscription in subscriptions:
+        subscription.load_cache()
+        subscription.replay()
+    if args.global_dedupe is not None:
+        prioritized = prioritize(subscriptions, args.global_dedupe)
+        deduplicate(prioritized, 'ingress')
+        deduplicate(prioritized, 'egress')
+
+
+def _render(
+    args: Args,
+    subscriptions: list['Subscription'],
+    profiler: 'utils.profiling.NullProfiler',
+):
+    """Fit subscriptions into templates and write outputs."""
+    from template.template import Template
+    from template.utils.proxyprovider import ProxyProviderWriter
+    from template.utils.ruleprovider import RuleProviderWriter
+    from template.utils.subscriptionadapter import open_adapters
+
+    if os.path.isdir(args.outputs[0]):
+        output_dir = args.outputs[0]
+    else:
+        output_dir = os.path.dirname(args.outputs[0])
+    rule_providers = None
+    if args.rule_providers:
+        rule_providers = RuleProviderWriter(
+            os.path.join(output_dir, 'rule-providers'),
+            args.rule_providers,
+            args.provider_url,
+        )
+    adapters = open_adapters(subscriptions, config.maxmind_db_path())
+    proxy_providers = None
+    if args.proxy_providers:
+        proxy_providers = ProxyProviderWriter(
+            os.path.join(output_dir, 'proxy-providers'), args.provider_url
+        )
+        proxy_providers.write(adapters)
     templates = [Template(path) for path in args.templates]
     for template in templates:
-        conf = template.fit(subscriptions, clash.Clash.MAXMIND_DB_PATH)
+        start = time.perf_counter()
+        conf = template.fit(adapters, proxy_providers)
+        if rule_providers:
+            rule_providers.apply(conf)
+        fitted = time.perf_counter()
         if os.path.isdir(args.outputs[0]):
             output_path = os.path.join(args.outputs[0], f'{template.id}.yaml')
         else:
             output_path = args.outputs[0]
         with open(output_path, 'w', encoding='utf-8') as fs:
-            yaml.safe_dump(conf, fs, allow_unicode=True)
+            Template.dump(conf, fs)
         logger.info('Wrote %s', output_path)
+        profiler.add_stages(
+            f'template {template.id}',
+            {'fit': fitted - start, 'dump': time.perf_counter() - fitted},
+        )
+
+
+def _fit(
+    args: Args,
+    profiler: 'utils.profiling.NullProfiler',
+    subscriptions: list['Subscription'],
+):
+    """Render filtered subscriptions, recording their stages."""
+    profiler.snapshot('filtered')
+    for subscription in subscriptions:
+        profiler.add_stages(subscription.name, subscription.durations)
+    _render(args, subscriptions, profiler)
+    profiler.snapshot('fitted')
+
+
+async def _main(
+    args: Args,
+    profiler: 'utils.profiling.NullProfiler',
+    subscriptions: list['Subscription'],
+):
+    """Merge subscriptions, which are parsed into `subscriptions`.
+
+    Return
+    ---
+    False if failed to fetch subscriptions.
+    """
+    from subscription.subscription import parse_subscription_config
+
+    subscriptions.extend(parse_subscription_config(args.subscription))
+    if not await _filter(args, subscriptions, profiler):
+        return False
+    _fit(args, profiler, subscriptions)
+    return True
+
+
+def _main_offline(args: Args, profiler: 'utils.profiling.NullProfiler'):
+    """Merge subscriptions from the last run, without starting an event loop."""
+    from subscription.subscription import parse_subscription_config
+
+    subscriptions = parse_subscription_config(args.subscription)
+    _replay(args, subscriptions)
+    _fit(args, profiler, subscriptions)
+
+
+def _summarize(
+    subscriptions: list['Subscription'], error: str, elapsed: float, max_error=500
+):
+    """Summarize a run in HTML, with proxy counts and durations of each stage.
+
+    Markup does not span lines, so the notifier can split the summary on line
+    boundaries. The error is cut to `max_error` characters before escaping.
+    """
+    if error:
+        lines = [f'<b>Failed to merge Clash subscriptions</b> in {elapsed:.1f}s']
+    else:
+        lines = [f'<b>Merged Clash subscriptions</b> in {elapsed:.1f}s']
+    for subscription in subscriptions:
+        counts = ' → '.join(
+            f'{stage} {count}' for stage, count in subscription.stage_counts.items()
+        )
+        lines.append(f'<b>{html.escape(subscription.name)}</b> {counts}')
+        if subscription.durations:
+            durations = ', '.join(
+                f'{stage} {seconds:.1f}s'
+                for stage, seconds in subscription.durations.items()
+            )
+            lines.append(f'  {durations}')
+    if error:
+        if len(error) > max_error:
+            error = error[: max_error - 1] + '…'
+        lines.extend(
+            f'<code>{html.escape(line)}</code>' for line in error.splitlines()
+        )
+    return '\n'.join(lines)
+
+
+async def _run(args: Args, profiler: 'utils.profiling.NullProfiler'):
+    """Run `_main` and notify its summary."""
+    import utils.notifier
+
+    if args.proxy:
+        os.environ['https_proxy'] = args.proxy
+        os.environ['http_proxy'] = args.proxy
+        os.environ['HTTPS_PROXY'] = args.proxy
+        os.environ['HTTP_PROXY'] = args.proxy
+    if os.environ.get('HTTPS_PROXY', ''):
+        logger.info('Using proxy %s', os.environ['HTTPS_PROXY'])
+
+    if args.api_key and args.chat_id:
+        logger.info('Telegram bot is enabled')
+        notifier = utils.notifier.Notifier(
+            TelegramBackend(args.api_key, args.chat_id, args.bot_url)
+        )
+    else:
+        logger.info('Telegram bot is disabled')
+        notifier = utils.notifier.NullNotifier()
+
+    async with notifier:
+        start = time.perf_counter()
+        subscriptions: list['Subscription'] = []
+        error = ''
+        try:
+            if not await _main(args, profiler, subscriptions):
+                error = 'Failed to fetch subscriptions'
+        except BaseException as e:
+            error = f'{type(e).__name__}: {e}'.rstrip(': ')
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            notifier.send(_summarize(subscriptions, error, elapsed))
 
 
 def main(args: Args):
     global logger
+    import utils.logging
+    import utils.profiling
 
     logger = utils.logging.init_logger(
-        config.APP_NAME, level='DEBUG' if args.verbose else 'INFO'
+        config.APP_NAME,
+        level='DEBUG' if args.verbose else 'INFO',
+        json_lines=args.log_json,
     )
-    if args.api_key and args.chat_id:
-        logger.info('Telegram bot is enabled')
-        bot = TelegramBot(args.api_key, args.chat_id)
+    if args.profile:
+        profiler = utils.profiling.Profiler(args.profile, args.profile_memory)
     else:
-        logger.info('Telegram bot is disabled')
-        bot = Mock()
+        profiler = utils.profiling.NullProfiler()
 
+    profiler.start()
     try:
-        asyncio.run(_main(args))
-        bot.send_message('Finish merging Clash subscriptions.')
+        if args.offline:
+            _main_offline(args, profiler)
+        else:
+            import asyncio
+
+            asyncio.run(_run(args, profiler))
     except KeyboardInterrupt:
         pass
     except:
         logger.exception('Failed to merge Clash subscriptions')
-        bot.send_message(f'Failed to merge Clash subscriptions\n{sys.exc_info()}')
+    finally:
+        profiler.stop()
 
 
 if __name__ == '__main__':
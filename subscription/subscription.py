@@ -1,22 +1,26 @@
 """Filter subscriptions."""
-import asyncio
-import copy
+import contextlib
 import functools
 import io
 import logging
 import os
-from typing import Iterable
+import time
+from typing import TYPE_CHECKING, Iterable, Mapping, Sequence
 
-import aiohttp
-import appdirs
-import yaml
-
-import clash
-import clash.utils.common
 import config
-import subscription.utils.filterrecorder
-import subscription.utils.net
 import utils.logging
+from subscription.utils import checkpoint, filterrecorder
+from subscription.utils.probe import (
+    LatencyTracker,
+    ProbeOptions,
+    RegionPredictor,
+    RegionQuota,
+    lookup_region,
+)
+from utils.lazy import cached_classproperty
+
+if TYPE_CHECKING:
+    import clash
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
 
@@ -24,7 +28,17 @@ logger = logging.getLogger(config.APP_NAME).getChild(__name__)
 class Subscription:
     """Clash subscription class."""
 
-    CACHE_DIR = os.path.join(appdirs.user_cache_dir(config.APP_NAME), 'subscriptions')
+    @cached_classproperty
+    def CACHE_DIR(cls) -> str:
+        import appdirs
+
+        return os.path.join(appdirs.user_cache_dir(config.APP_NAME), 'subscriptions')
+
+    @cached_classproperty
+    def CHECKPOINT_DIR(cls) -> str:
+        import appdirs
+
+        return os.path.join(appdirs.user_cache_dir(config.APP_NAME), 'checkpoints')
 
     def __init__(self, name: str, url: str, patterns: Iterable[str]) -> None:
         self._logger = utils.logging.IDAdapter(logger, {'id': name})
@@ -32,7 +46,10 @@ class Subscription:
         self._url = url
         self._patterns = patterns
         self.__raw_content: str
-        self.collection: subscription.utils.filterrecorder.FilterRecorderCollection
+        self.collection: filterrecorder.FilterRecorderCollection
+        self._checkpoint: checkpoint.Checkpoint
+        self.durations: dict[str, float] = {}
+        '''wall time in seconds of each stage run'''
 
     @property
     def _raw_content(self) -> str:
@@ -44,7 +61,7 @@ class Subscription:
             os.makedirs(self.CACHE_DIR, exist_ok=True)
             path = os.path.join(self.CACHE_DIR, f'{self.name}.yaml')
             try:
-                with open(path, 'w', encoding='utf-8') as fs:
+                with open(path, 'w', encoding='utf-8', newline='') as fs:
                     fs.write(value)
             except OSError:
                 self._logger.warning("Failed to write subscription cache file %s", path)
@@ -54,154 +71,438 @@ class Subscription:
             )
         self.__raw_content = value
 
+    @contextlib.contextmanager
+    def _timed(self, stage: str):
+        """Record the wall time of a stage into `durations`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage] = time.perf_counter() - start
+
     async def fetch(self, timeout=10):
         """Fetch subscription raw content."""
+        import aiohttp
+
         client_timeout = aiohttp.ClientTimeout(total=timeout)
-        async with aiohttp.ClientSession(
-            timeout=client_timeout, trust_env=True
-        ) as session:
-            self._logger.info("Fetching subscription")
-            async with session.get(self._url, allow_redirects=False, ssl=False) as resp:
-                self._raw_content = await resp.text(encoding='utf-8')
-                return self._raw_content
+        with self._timed('fetch'):
+            async with aiohttp.ClientSession(
+                timeout=client_timeout, trust_env=True
+            ) as session:
+                self._logger.info("Fetching subscription")
+                async with session.get(
+                    self._url, allow_redirects=False, ssl=False
+                ) as resp:
+                    self._raw_content = await resp.text(encoding='utf-8')
+                    return self._raw_content
+
+    def load_cache(self):
+        """Load subscription raw content cached by the last fetch."""
+        path = os.path.join(self.CACHE_DIR, f'{self.name}.yaml')
+        with open(path, 'r', encoding='utf-8', newline='') as fs:
+            self.__raw_content = fs.read()
+        return self.__raw_content
 
     @functools.cached_property
     def content(self) -> dict:
         """Get subscription parsed content."""
+        import yaml
+
         if not self._raw_content:
             raise ValueError("Subscription content not fetched")
         return yaml.safe_load(io.StringIO(self._raw_content))
 
-    def _name_filter(self, proxies: list[dict]):
+    def _name_filter(self, table: filterrecorder.ProxyTable, ids: Sequence[int]):
         """Filter proxies by name."""
-        names: list[str] = [proxy['name'] for proxy in proxies]
-        recorder = subscription.utils.filterrecorder.ProxyNameFilterRecorder()
-        recorder.source = copy.copy(proxies)
+        recorder = filterrecorder.ProxyNameFilterRecorder(table)
+        recorder.source_ids.extend(ids)
         if not self._patterns:
-            recorder.accepted = recorder.source
+            recorder.accepted_ids.extend(ids)
         else:
-            for name, proxy in zip(names, proxies):
-                rejected = False
+            for i in ids:
+                name: str = table[i]['name']
                 for pattern in self._patterns:
                     if pattern in name:
-                        recorder.rejected[pattern].append(proxy)
-                        rejected = True
+                        recorder.rejected_ids[pattern].append(i)
                         break
-                if not rejected:
-                    recorder.accepted.append(proxy)
+                else:
+                    recorder.accepted_ids.append(i)
         self._logger.info(
-            '%d / %d proxies accepted after name filter', len(recorder), len(proxies)
+            '%d / %d proxies accepted after name filter',
+            len(recorder),
+            len(ids),
+            extra={'stage': 'name'},
         )
         return recorder
 
-    async def _ingress_filter(self, proxies: list[dict]):
+    async def _ingress_filter(
+        self, table: filterrecorder.ProxyTable, ids: Sequence[int]
+    ):
         """Filter proxies by ingress records."""
-        recorder = subscription.utils.filterrecorder.ProxyIngressFilterRecorder()
-        recorder.source = copy.copy(proxies)
-        servers: list[str] = [proxy['server'] for proxy in proxies]
+        import asyncio
+
+        import subscription.utils.net
+
+        recorder = filterrecorder.ProxyIngressFilterRecorder(table)
+        recorder.source_ids.extend(ids)
+        servers: list[str] = [table[i]['server'] for i in ids]
         ip_list = await asyncio.gather(
             *[subscription.utils.net.convert_server_to_ip(server) for server in servers]
         )
-        for proxy, ip in zip(proxies, ip_list):
-            port = proxy['port']
+        for i, ip in zip(ids, ip_list):
+            port = table[i]['port']
             key = f'{ip}:{port}'
             if ip == '':
-                recorder.rejected[''].append(proxy)
-            elif key in recorder.accepted.keys():
-                recorder.rejected[key].append(proxy)
+                recorder.rejected_ids[''].append(i)
+            elif key in recorder.accepted_ids:
+                recorder.rejected_ids[key].append(i)
             else:
-                recorder.accepted[key] = proxy
-        for key in recorder.rejected.keys():
+                recorder.accepted_ids[key] = i
+        for key in recorder.rejected_ids.keys():
+            if key == '':
+                continue
             # The first proxy in the rejected list is the accepted one
-            recorder.rejected[key].insert(0, recorder.accepted[key])
+            recorder.rejected_ids[key].insert(0, recorder.accepted_ids[key])
         self._logger.info(
-            '%d / %d proxies accepted after ingress filter', len(recorder), len(proxies)
+            '%d / %d proxies accepted after ingress filter',
+            len(recorder),
+            len(ids),
+            extra={'stage': 'ingress'},
         )
         return recorder
 
     async def _connectivity_filter(
-        self, clash_instance: clash.Clash, proxies: list[dict]
+        self,
+        clash_instance: 'clash.Clash',
+        table: filterrecorder.ProxyTable,
+        ids: Sequence[int],
+        options: ProbeOptions,
     ):
-        """Filter proxies by connectivity."""
+        """Filter proxies by connectivity.
+
+        Each proxy is pinged against every target of `options.targets`
+        concurrently, it is accepted if it reaches all the required targets.
+        """
+        import asyncio
+
         assert clash_instance.poll() is None, "Clash instance not started"
-        recorder = subscription.utils.filterrecorder.ConnectivityFilterRecorder()
-        recorder.source = copy.copy(proxies)
-        names = [proxy['name'] for proxy in proxies]
-        resps = await asyncio.gather(*[clash_instance.ping(name) for name in names])
-        self._logger.debug('Connectivity responses: \n%s', '\n'.join(map(str, resps)))
-        for proxy, resp in zip(proxies, resps):
-            if 'delay' in resp:
-                recorder.accepted.append(proxy)
+        recorder = filterrecorder.ConnectivityFilterRecorder(table)
+        recorder.source_ids.extend(ids)
+        trackers = dict(
+            (target, LatencyTracker(options.ping_timeout)) for target in options.targets
+        )
+        required = options.required
+        # Pings run on a pooled worker, log them under this subscription
+        ping_logger = utils.logging.IDAdapter(
+            logger, {'id': self.name, 'stage': 'connectivity'}
+        )
+        if options.concurrency:
+            semaphore = asyncio.Semaphore(options.concurrency)
+        else:
+            semaphore = contextlib.nullcontext()
+
+        async def ping(i: int, target: str):
+            async with semaphore:
+                tracker = trackers[target]
+                timeout = round(tracker.timeout * 1000)
+                resp = await clash_instance.ping(
+                    table[i]['name'], timeout, options.targets[target], ping_logger
+                )
+                if 'delay' in resp:
+                    tracker.record(resp['delay'] / 1000)
+                return resp
+
+        async def probe(i: int):
+            resps = await asyncio.gather(*[ping(i, target) for target in trackers])
+            return dict(zip(trackers, resps))
+
+        resps = await asyncio.gather(*[probe(i) for i in ids])
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(
+                'Connectivity responses: \n%s',
+                '\n'.join(map(str, resps)),
+                extra={'stage': 'connectivity'},
+            )
+        for i, resp in zip(ids, resps):
+            for target, target_resp in resp.items():
+                if 'delay' in target_resp:
+                    recorder.target_ids[target].append(i)
+            if all('delay' in resp[target] for target in required):
+                recorder.accepted_ids.append(i)
             else:
-                recorder.rejected.append(proxy)
+                recorder.rejected_ids.append(i)
         self._logger.info(
-            '%d / %d proxies accepted after connectivity filter',
+            '%d / %d proxies accepted after connectivity filter, timeout %s',
             len(recorder),
-            len(names),
+            len(ids),
+            ', '.join(
+                f'{target} {tracker.timeout:.2f}s'
+                for target, tracker in trackers.items()
+            ),
+            extra={'stage': 'connectivity'},
         )
         return recorder
 
-    async def _egress_filter(self, clash_instance: clash.Clash, proxies: list[dict]):
-        """Filter proxies by egress."""
+    async def _egress_filter(
+        self,
+        clash_instance: 'clash.Clash',
+        table: filterrecorder.ProxyTable,
+        ids: Sequence[int],
+        options: ProbeOptions,
+        regions: Mapping[int, str],
+        reader=None,
+    ):
+        """Filter proxies by egress.
+
+        With a region quota, proxies are counted by egress region, and the
+        lookup is skipped for proxies predicted to exit in a full region.
+
+        Args
+        ---
+        regions: key: proxy index, value: region of the ingress IP
+        reader: maxmind reader to count the egress regions for the quota
+        """
+        import asyncio
+
+        import subscription.utils.net
+
         assert clash_instance.poll() is None, "Clash instance not started"
-        self._logger.info('Filtering proxies by egress')
-        recorder = subscription.utils.filterrecorder.EgressFilterRecorder()
-        recorder.source = copy.copy(proxies)
-        names = [proxy['name'] for proxy in proxies]
-        ip_list = []
-        for i, name in enumerate(names):
+        self._logger.info('Filtering proxies by egress', extra={'stage': 'egress'})
+        recorder = filterrecorder.EgressFilterRecorder(table)
+        recorder.source_ids.extend(ids)
+        tracker = LatencyTracker(options.egress_timeout)
+        quota = RegionQuota(options.region_quota if reader else 0)
+        predictor = RegionPredictor()
+        switch_logger = utils.logging.IDAdapter(
+            logger, {'id': self.name, 'stage': 'egress'}
+        )
+        loop = asyncio.get_running_loop()
+        for n, i in enumerate(ids):
+            name = table[i]['name']
+            if quota.full(predictor.predict(regions.get(i, ''))):
+                recorder.skipped_ids.append(i)
+                continue
             self._logger.info(
-                'egress ip lookup for %s, progress %d / %d, ', name, i + 1, len(names)
+                'egress ip lookup for %s, progress %d / %d, ',
+                name,
+                n + 1,
+                len(ids),
+                extra={'stage': 'egress', 'proxy': name},
             )
-            if not await clash_instance.switch('GLOBAL', name):
-                ip_list.append('')
+            if not await clash_instance.switch('GLOBAL', name, switch_logger):
+                recorder.rejected_ids[''].append(i)
                 continue
             http_proxy = f'http://127.0.0.1:{clash_instance.port}'
-            ip = await subscription.utils.net.get_egress_ip(http_proxy)
-            ip_list.append(ip)
-
-        # Similar process to ns_filter
-        for proxy, ip in zip(proxies, ip_list):
+            start = loop.time()
+            ip = await subscription.utils.net.get_egress_ip(
+                http_proxy, tracker.timeout
+            )
+            # Similar process to ns_filter
             if ip == '':
-                recorder.rejected[''].append(proxy)
-            elif ip in recorder.accepted.keys():
-                recorder.rejected[ip].append(proxy)
+                recorder.rejected_ids[''].append(i)
+            elif ip in recorder.accepted_ids:
+                recorder.rejected_ids[ip].append(i)
             else:
-                recorder.accepted[ip] = proxy
-        for ip in recorder.rejected.keys():
-            recorder.rejected[ip].insert(0, recorder.accepted[ip])
+                tracker.record(loop.time() - start)
+                if reader is not None:
+                    region = lookup_region(reader, ip)
+                    predictor.observe(regions.get(i, ''), region)
+                    if quota.full(region):
+                        recorder.skipped_ids.append(i)
+                        continue
+                    quota.add(region)
+                recorder.accepted_ids[ip] = i
+        for ip in recorder.rejected_ids.keys():
+            if ip == '':
+                continue
+            recorder.rejected_ids[ip].insert(0, recorder.accepted_ids[ip])
 
         self._logger.info(
-            '%d / %d proxies accepted after egress filter', len(recorder), len(names)
+            '%d / %d proxies accepted after egress filter, %d skipped, timeout %.2fs',
+            len(recorder),
+            len(ids),
+            len(recorder.skipped_ids),
+            tracker.timeout,
+            extra={'stage': 'egress'},
         )
         return recorder
 
-    async def filter(self, port: int, controller_port: int):
-        """Filter proxies."""
+    def _open_checkpoint(self, resume: bool) -> checkpoint.Checkpoint:
+        """Get the checkpoint of this run, resumed from the last run if asked."""
+        path = os.path.join(self.CHECKPOINT_DIR, f'{self.name}.json')
+        digest = checkpoint.digest(self._raw_content)
+        if resume:
+            last = checkpoint.Checkpoint.load(path, digest)
+            if last is None:
+                self._logger.info('No matching checkpoint, starting over')
+            elif last.stages:
+                self._logger.info('Resuming after %s filter', last.last_stage)
+                return last
+        table = filterrecorder.ProxyTable(self.content['proxies'])
+        return checkpoint.Checkpoint(path, digest, table)
 
-        proxies = self.content['proxies']
-        conf = clash.utils.common.build_simple_config(port, controller_port, proxies)
-        clash_instance = clash.Clash(conf, self.name)
-        clash_instance.start()
-        proxies = self.content['proxies']
-        recorder_name = self._name_filter(proxies)
-        recorder_ingress = await self._ingress_filter(recorder_name.accepted)
-        recorder_connectivity = await self._connectivity_filter(
-            clash_instance, list(recorder_ingress.accepted.values())
-        )
-        recorder_egress = await self._egress_filter(
-            clash_instance, recorder_connectivity.accepted
-        )
-        del clash_instance
-        collection = subscription.utils.filterrecorder.FilterRecorderCollection(
-            recorder_name, recorder_ingress, recorder_connectivity, recorder_egress
-        )
+    def replay(self):
+        """Load the filter results recorded by the last run on the same content.
+
+        No clash or network access, the last run must have finished all stages.
+        """
+        path = os.path.join(self.CHECKPOINT_DIR, f'{self.name}.json')
+        with self._timed('replay'):
+            ckpt = checkpoint.Checkpoint.load(
+                path, checkpoint.digest(self._raw_content)
+            )
+        if ckpt is None or ckpt.last_stage != checkpoint.STAGES[-1]:
+            raise ValueError(f'No complete checkpoint for subscription {self.name}')
+        self._logger.info('Replaying %d proxies', len(ckpt.stages['egress']))
+        self._checkpoint = ckpt
+        self.collection = filterrecorder.FilterRecorderCollection(**ckpt.stages)
+        return self.collection
+
+    async def prefilter(self, resume=False):
+        """Filter proxies by name and ingress, no clash needed.
+
+        Every finished stage is checkpointed, with `resume` the stages finished
+        by the last run on the same subscription content are skipped.
+        """
+        with self._timed('parse'):
+            self._checkpoint = ckpt = self._open_checkpoint(resume)
+        table = ckpt.table
+        done = ckpt.stages
+        if 'name' not in done:
+            with self._timed('name'):
+                ckpt.update('name', self._name_filter(table, table.ids()))
+        if 'ingress' not in done:
+            with self._timed('ingress'):
+                ckpt.update(
+                    'ingress',
+                    await self._ingress_filter(table, done['name'].accepted_ids),
+                )
+
+    async def probe(
+        self,
+        pool: 'clash.ClashPool',
+        options: ProbeOptions | None = None,
+        reader=None,
+    ):
+        """Filter proxies by connectivity and egress, must follow `prefilter`.
+
+        Args
+        ---
+        reader: maxmind reader, required by the region quota of `options`
+        """
+        options = options or ProbeOptions()
+        ckpt = self._checkpoint
+        table = ckpt.table
+        done = ckpt.stages
+        ingress_ids = set(done['ingress'].accepted_ids.values())
+        if 'connectivity' in done and not ingress_ids.issubset(
+            done['connectivity'].source_ids
+        ):
+            # Proxies shadowed by the last run are loaded unshadowed, those
+            # the global deduplication of this run keeps were never probed
+            self._logger.info(
+                'Proxies unshadowed since the checkpoint, probing again',
+                extra={'stage': 'connectivity'},
+            )
+            ckpt.truncate('ingress')
+        regions: dict[int, str] = {}
+        if options.region_quota and reader is not None:
+            for key, i in done['ingress'].accepted_ids.items():
+                ip = key.rsplit(':', 1)[0]
+                regions[i] = lookup_region(reader, ip)
+        if 'egress' not in done:
+            async with pool.acquire(table.to_compact()) as clash_instance:
+                if 'connectivity' not in done:
+                    with self._timed('connectivity'):
+                        ckpt.update(
+                            'connectivity',
+                            await self._connectivity_filter(
+                                clash_instance,
+                                table,
+                                list(done['ingress'].accepted_ids.values()),
+                                options,
+                            ),
+                        )
+                with self._timed('egress'):
+                    ckpt.update(
+                        'egress',
+                        await self._egress_filter(
+                            clash_instance,
+                            table,
+                            done['connectivity'].accepted_ids,
+                            options,
+                            regions,
+                            reader,
+                        ),
+                    )
+        collection = filterrecorder.FilterRecorderCollection(**done)
         self.collection = collection
         return collection
 
+    @property
+    def stage_counts(self) -> dict[str, int]:
+        """Number of proxies accepted by each finished stage.
+
+        key: 'proxies' for the whole subscription, or a stage name
+        """
+        ckpt: checkpoint.Checkpoint | None = getattr(self, '_checkpoint', None)
+        if ckpt is None:
+            return {}
+        counts = {'proxies': len(ckpt.table)}
+        for stage, recorder in ckpt.stages.items():
+            counts[stage] = len(recorder)
+        return counts
+
+    def deduplicate(self, stage: str, owners: dict[str, str]):
+        """Drop the proxies whose IP is owned by another subscription.
+
+        Args
+        ---
+        stage: 'ingress' or 'egress', the stage must have been finished
+        owners: key: IP, value: name of the owning subscription, updated in place
+        """
+        recorder: filterrecorder.KeyedFilterRecorder = self._checkpoint.stages[stage]
+        total = len(recorder) + len(recorder.shadowed_ids)
+        recorder.deduplicate(owners, self.name)
+        self._logger.info(
+            '%d / %d proxies accepted after global %s deduplication',
+            len(recorder),
+            total,
+            stage,
+            extra={'stage': stage},
+        )
+
+    async def filter(
+        self,
+        pool: 'clash.ClashPool',
+        resume=False,
+        options: ProbeOptions | None = None,
+        reader=None,
+    ):
+        """Filter proxies."""
+        await self.prefilter(resume)
+        return await self.probe(pool, options, reader)
+
+
+def deduplicate(subscriptions: Sequence[Subscription], stage: str):
+    """Deduplicate proxies by ingress or egress IP across subscriptions.
+
+    Only the proxy of the first subscription in `subscriptions` holding an IP
+    is kept, the others are recorded as shadowed.
+
+    Args
+    ---
+    stage: 'ingress' or 'egress', the stage must have been finished
+    """
+    owners: dict[str, str] = {}
+    for sub in subscriptions:
+        sub.deduplicate(stage, owners)
+
 
 def parse_subscription_config(path: str) -> list[Subscription]:
     """Parse subscription config from file."""
+    import yaml
+
     with open(path, 'r', encoding='utf-8') as fs:
         sub_confs = yaml.safe_load(fs)
     subscriptions = []
@@ -0,0 +1,98 @@
+"""Persist finished filter stages so that an interrupted run can be resumed."""
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+
+import config
+from subscription.utils.filterrecorder import (
+    FilterRecorder,
+    FilterRecorderCollection,
+    KeyedFilterRecorder,
+    ProxyTable,
+)
+
+logger = logging.getLogger(config.APP_NAME).getChild(__name__)
+
+STAGES = tuple(f.name for f in dataclasses.fields(FilterRecorderCollection))
+'''stage names in the order they are run'''
+
+
+def digest(raw_content: str) -> str:
+    """Hash of the subscription raw content a checkpoint belongs to."""
+    return hashlib.sha256(raw_content.encode('utf-8')).hexdigest()
+
+
+class Checkpoint:
+    """Recorders of the finished stages of one subscription."""
+
+    def __init__(self, path: str, digest_: str, table: ProxyTable) -> None:
+        self.path = path
+        self.digest = digest_
+        self.table = table
+        self.stages: dict[str, FilterRecorder] = {}
+        '''key: stage name, value: recorder, only leading finished stages'''
+
+    @classmethod
+    def load(cls, path: str, digest_: str):
+        """Load a checkpoint.
+
+        Return
+        ---
+        The checkpoint, or None if it is missing, corrupt or belongs to
+        another subscription content.
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as fs:
+                data = json.load(fs)
+        except (OSError, ValueError):
+            return None
+        if data.get('digest') != digest_:
+            return None
+        checkpoint = cls(path, digest_, ProxyTable.from_compact(data['proxies']))
+        types = {f.name: f.type for f in dataclasses.fields(FilterRecorderCollection)}
+        for stage in STAGES:
+            if stage not in data['stages']:
+                break
+            recorder = types[stage].from_compact(
+                checkpoint.table, data['stages'][stage]
+            )
+            if isinstance(recorder, KeyedFilterRecorder):
+                # The global deduplication of the last run may be reordered or
+                # off in this one, which deduplicates again if asked
+                recorder.unshadow()
+            checkpoint.stages[stage] = recorder
+        return checkpoint
+
+    def update(self, stage: str, recorder: FilterRecorder):
+        """Record a finished stage and persist the checkpoint."""
+        self.stages[stage] = recorder
+        self.save()
+        return recorder
+
+    def truncate(self, stage: str):
+        """Forget the stages after `stage`, so that they are run again."""
+        for later in STAGES[STAGES.index(stage) + 1 :]:
+            self.stages.pop(later, None)
+
+    def save(self):
+        data = {
+            'digest': self.digest,
+            'proxies': self.table.to_compact(),
+            'stages': {
+                stage: recorder.to_compact() for stage, recorder in self.stages.items()
+            },
+        }
+        tmp_path = f'{self.path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as fs:
+                json.dump(data, fs, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.warning('Failed to write checkpoint %s', self.path)
+
+    @property
+    def last_stage(self) -> str:
+        return next(reversed(self.stages), '')
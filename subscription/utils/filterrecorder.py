@@ -1,56 +1,255 @@
 """Record the filtering process.
 
+Proxies are stored once per subscription in a `ProxyTable`, recorders only
+keep integer indices into it. `source`, `accepted` and `rejected` are
+read-only views which resolve the indices back to proxy dicts.
+
 NOTE: The subclasses should be used in sequence.
 """
+import dataclasses
 import json
+from array import array
 from collections import defaultdict
+from collections.abc import Mapping, Sequence
 from dataclasses import dataclass, field
-from typing import Collection, List, MutableMapping, Sequence
+from typing import Iterable, MutableMapping
+
+
+def _ids(values: Iterable[int] = ()) -> array:
+    """Compact list of proxy indices."""
+    return array('I', values)
+
+
+class ProxyTable:
+    """Proxies of one subscription, stored once and addressed by index."""
+
+    __slots__ = ('_proxies',)
+
+    def __init__(self, proxies: Iterable[dict]) -> None:
+        self._proxies = tuple(proxies)
+
+    def __len__(self):
+        return len(self._proxies)
+
+    def __getitem__(self, index: int) -> dict:
+        return self._proxies[index]
+
+    def ids(self) -> array:
+        """Indices of all proxies."""
+        return _ids(range(len(self._proxies)))
+
+    def to_compact(self) -> list[dict]:
+        return list(self._proxies)
+
+    @classmethod
+    def from_compact(cls, data: list[dict]):
+        return cls(data)
+
+
+class ProxyListView(Sequence):
+    """View of a list of indices as a list of proxies."""
+
+    __slots__ = ('_table', '_ids')
+
+    def __init__(self, table: ProxyTable, ids: Sequence[int]) -> None:
+        self._table = table
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._table[i] for i in self._ids[index]]
+        return self._table[self._ids[index]]
+
+    @staticmethod
+    def pack(ids: Sequence[int]):
+        return list(ids)
+
+    @staticmethod
+    def unpack(data):
+        return _ids(data)
+
+
+class ProxyMappingView(Mapping):
+    """View of `key -> index` as `key -> proxy`."""
+
+    __slots__ = ('_table', '_ids')
+
+    def __init__(self, table: ProxyTable, ids: Mapping[str, int]) -> None:
+        self._table = table
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __getitem__(self, key: str) -> dict:
+        return self._table[self._ids[key]]
+
+    @staticmethod
+    def pack(ids: Mapping[str, int]):
+        return dict(ids)
+
+    @staticmethod
+    def unpack(data):
+        return dict(data)
+
+
+class ProxyGroupView(Mapping):
+    """View of `key -> list of indices` as `key -> list of proxies`."""
+
+    __slots__ = ('_table', '_ids')
+
+    def __init__(self, table: ProxyTable, ids: Mapping[str, Sequence[int]]) -> None:
+        self._table = table
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __getitem__(self, key: str) -> ProxyListView:
+        return ProxyListView(self._table, self._ids[key])
+
+    @staticmethod
+    def pack(ids: Mapping[str, Sequence[int]]):
+        return {key: list(value) for key, value in ids.items()}
+
+    @staticmethod
+    def unpack(data):
+        return defaultdict(_ids, {key: _ids(value) for key, value in data.items()})
 
 
 @dataclass
 class FilterRecorder:
     """A base class used to record filtering."""
 
-    rejected: object
-    accepted: Collection
-    source: Sequence
+    _VIEWS = {
+        'source_ids': ProxyListView,
+        'accepted_ids': ProxyListView,
+        'rejected_ids': ProxyListView,
+        'skipped_ids': ProxyListView,
+    }
+
+    table: ProxyTable
+    source_ids: array = field(default_factory=_ids)
+    '''indices of the proxies fed into the filter'''
+    accepted_ids: object = field(default_factory=_ids)
+    rejected_ids: object = field(default_factory=_ids)
 
     def __len__(self):
-        return len(self.accepted)
+        return len(self.accepted_ids)
 
     def __iter__(self):
         return iter(self.accepted)
 
+    def _view(self, name: str):
+        return self._VIEWS[name](self.table, getattr(self, name))
+
+    @property
+    def source(self) -> ProxyListView:
+        return self._view('source_ids')
+
+    @property
+    def accepted(self):
+        return self._view('accepted_ids')
+
+    @property
+    def rejected(self):
+        return self._view('rejected_ids')
+
+    def to_compact(self) -> dict:
+        """Serialize the indices, the proxy table is serialized separately."""
+        compact = {}
+        for f in dataclasses.fields(self):
+            if f.name == 'table':
+                continue
+            value = getattr(self, f.name)
+            view = self._VIEWS.get(f.name)
+            compact[f.name] = view.pack(value) if view else value
+        return compact
+
+    @classmethod
+    def from_compact(cls, table: ProxyTable, data: dict):
+        kwargs = {}
+        for f in dataclasses.fields(cls):
+            if f.name == 'table' or f.name not in data:
+                continue
+            view = cls._VIEWS.get(f.name)
+            kwargs[f.name] = view.unpack(data[f.name]) if view else data[f.name]
+        return cls(table, **kwargs)
+
 
 @dataclass
 class ProxyNameFilterRecorder(FilterRecorder):
     '''Record the 'filter by proxy name' operation.'''
 
-    rejected: MutableMapping[str, List[dict]] = field(
-        default_factory=lambda: defaultdict(list)
+    _VIEWS = FilterRecorder._VIEWS | {'rejected_ids': ProxyGroupView}
+
+    rejected_ids: MutableMapping[str, array] = field(
+        default_factory=lambda: defaultdict(_ids)
     )
-    '''key: pattern, value: list of proxies'''
-    accepted: List[dict] = field(default_factory=list)
-    '''list of proxies'''
-    source: List[dict] = field(default_factory=list)
-    '''list of proxies'''
+    '''key: pattern, value: indices of proxies'''
+    accepted_ids: array = field(default_factory=_ids)
+    '''indices of proxies'''
 
 
 @dataclass
-class ProxyIngressFilterRecorder(FilterRecorder):
-    '''Record the 'filter by ns records' operation.'''
+class KeyedFilterRecorder(FilterRecorder):
+    '''A base class for filters deduplicating proxies by an IP key.'''
 
-    rejected: MutableMapping[str, list] = field(
-        default_factory=lambda: defaultdict(list)
-    )
-    '''key: IP, value: list of proxies'''
-    accepted: MutableMapping[str, dict] = field(
-        default_factory=lambda: defaultdict(dict)
+    _VIEWS = FilterRecorder._VIEWS | {
+        'rejected_ids': ProxyGroupView,
+        'accepted_ids': ProxyMappingView,
+        'shadowed_ids': ProxyMappingView,
+    }
+
+    rejected_ids: MutableMapping[str, array] = field(
+        default_factory=lambda: defaultdict(_ids)
     )
-    '''key: IP, value: proxy'''
-    source: List[dict] = field(default_factory=list)
-    '''list of proxies'''
+    '''key: IP, value: indices of proxies'''
+    accepted_ids: MutableMapping[str, int] = field(default_factory=dict)
+    '''key: IP, value: index of proxy'''
+    shadowed_ids: MutableMapping[str, int] = field(default_factory=dict)
+    '''key: IP, value: index of proxy dropped by the global deduplication'''
+    shadowed_by: MutableMapping[str, str] = field(default_factory=dict)
+    '''key: IP, value: name of the subscription whose proxy is kept'''
+
+    @property
+    def shadowed(self) -> ProxyMappingView:
+        return self._view('shadowed_ids')
+
+    def unshadow(self):
+        """Accept the proxies dropped by the global deduplication again."""
+        self.accepted_ids.update(self.shadowed_ids)
+        self.shadowed_ids.clear()
+        self.shadowed_by.clear()
+
+    def deduplicate(self, owners: MutableMapping[str, str], name: str):
+        """Drop the keys already owned by another subscription.
+
+        Args
+        ---
+        owners: key: IP, value: name of the owning subscription, updated in place
+        name: name of the subscription this recorder belongs to
+        """
+        self.unshadow()
+        for key in list(self.accepted_ids):
+            owner = owners.setdefault(key, name)
+            if owner != name:
+                self.shadowed_ids[key] = self.accepted_ids.pop(key)
+                self.shadowed_by[key] = owner
+
+
+@dataclass
+class ProxyIngressFilterRecorder(KeyedFilterRecorder):
+    '''Record the 'filter by ns records' operation.'''
 
     def __str__(self):
         compact = defaultdict(list)
@@ -64,25 +263,33 @@ class ProxyIngressFilterRecorder(FilterRecorder):
 class ConnectivityFilterRecorder(FilterRecorder):
     '''Record the 'filter by clash ping connectivity' operation.'''
 
-    rejected: List[dict] = field(default_factory=list)
-    '''list of proxies'''
-    accepted: List[dict] = field(default_factory=list)
-    '''list of proxies'''
-    source: List[dict] = field(default_factory=list)
-    '''list of proxies'''
+    _VIEWS = FilterRecorder._VIEWS | {'target_ids': ProxyGroupView}
+
+    rejected_ids: array = field(default_factory=_ids)
+    '''indices of proxies'''
+    accepted_ids: array = field(default_factory=_ids)
+    '''indices of proxies'''
+    target_ids: MutableMapping[str, array] = field(
+        default_factory=lambda: defaultdict(_ids)
+    )
+    '''key: probe target, value: indices of proxies reaching it'''
+
+    @property
+    def targets(self) -> ProxyGroupView:
+        return self._view('target_ids')
 
 
 @dataclass
-class EgressFilterRecorder(FilterRecorder):
+class EgressFilterRecorder(KeyedFilterRecorder):
     '''Record the 'filter by egress' operation.'''
 
-    rejected: MutableMapping[str, list] = field(
-        default_factory=lambda: defaultdict(list)
-    )
-    accepted: MutableMapping[str, dict] = field(
-        default_factory=lambda: defaultdict(dict)
-    )
-    source: List[dict] = field(default_factory=list)
+    skipped_ids: array = field(default_factory=_ids)
+    '''indices of proxies dropped, or not probed, as their region quota was
+    reached'''
+
+    @property
+    def skipped(self) -> ProxyListView:
+        return self._view('skipped_ids')
 
 
 @dataclass
@@ -91,3 +298,7 @@ class FilterRecorderCollection:
     ingress: ProxyIngressFilterRecorder
     connectivity: ConnectivityFilterRecorder
     egress: EgressFilterRecorder
+
+    @property
+    def table(self) -> ProxyTable:
+        return self.name.table
@@ -3,8 +3,6 @@ import logging
 import socket
 from ipaddress import ip_address
 
-import aiohttp
-
 import config
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
@@ -47,8 +45,9 @@ EGRESS_FINDERS = (
     'https://icanhazip.com',
 )
 
-
 async def _get_egress_ip(finder: str, http_proxy: str | None = None, timeout=10):
+    import aiohttp
+
     client_timeout = aiohttp.ClientTimeout(total=timeout)
     async with aiohttp.ClientSession(timeout=client_timeout) as session:
         async with session.get(finder, proxy=http_proxy, ssl=False) as resp:
@@ -57,17 +56,23 @@ async def _get_egress_ip(finder: str, http_proxy: str | None = None, timeout=10)
             return ip
 
 
-async def get_egress_ip(http_proxy: str | None = None):
+async def get_egress_ip(http_proxy: str | None = None, timeout=10.0):
     """Get egress ip address.
 
+    Args
+    ---
+    timeout: seconds for each finder
+
     Return
     ---
     IP address, or an empty string if failed.
     """
+    import aiohttp
+
     for finder in EGRESS_FINDERS:
         try:
-            return await _get_egress_ip(finder, http_proxy)
-        except aiohttp.ClientError:
+            return await _get_egress_ip(finder, http_proxy, timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             logger.debug('Error when getting egress ip', exc_info=True)
             continue
     logger.warning("Exhausted all egress finders, failed to get egress ip")
@@ -0,0 +1,130 @@
+"""Probe targets, adaptive timeouts and region cutoff for the probing filters."""
+import bisect
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+
+FAMILY_TARGETS = {
+    'ipv4': 'http://ipv4.icanhazip.com',
+    'ipv6': 'http://ipv6.icanhazip.com',
+}
+'''connectivity probe targets only reachable over one address family'''
+
+
+@dataclass
+class TimeoutPolicy:
+    """Derive a probe timeout from the observed latencies.
+
+    The timeout is a high percentile of the latencies plus a relative margin,
+    clamped into `[floor, ceiling]`. `ceiling` is used until `min_samples`
+    latencies are observed.
+    """
+
+    floor: float
+    '''seconds'''
+    ceiling: float
+    '''seconds'''
+    percentile: float = 95
+    margin: float = 0.5
+    min_samples: int = 5
+
+
+class LatencyTracker:
+    """Latency distribution of one probing filter of one subscription."""
+
+    def __init__(self, policy: TimeoutPolicy) -> None:
+        self._policy = policy
+        self._samples: list[float] = []
+
+    def record(self, latency: float):
+        """Record the latency of a successful probe in seconds."""
+        bisect.insort(self._samples, latency)
+
+    @property
+    def timeout(self) -> float:
+        """Current timeout in seconds."""
+        policy = self._policy
+        if len(self._samples) < policy.min_samples:
+            return policy.ceiling
+        rank = math.ceil(policy.percentile / 100 * len(self._samples)) - 1
+        latency = self._samples[min(max(rank, 0), len(self._samples) - 1)]
+        return min(max(latency * (1 + policy.margin), policy.floor), policy.ceiling)
+
+
+def lookup_region(reader, ip: str) -> str:
+    """Look up the ISO country code of an IP in a maxmind reader.
+
+    Return
+    ---
+    Country code, or an empty string if unknown.
+    """
+    try:
+        return reader.get(ip)['country']['iso_code']
+    except (KeyError, TypeError, ValueError):
+        return ''
+
+
+class RegionQuota:
+    """Count healthy proxies per region, to stop probing full regions."""
+
+    def __init__(self, quota: int) -> None:
+        """
+        Args
+        ---
+        quota: healthy proxies wanted per region, 0 for unlimited
+        """
+        self._quota = quota
+        self._counts: Counter[str] = Counter()
+
+    def full(self, region: str) -> bool:
+        """Whether a region is full, an unknown region, i.e. '', never is."""
+        return bool(self._quota and region) and self._counts[region] >= self._quota
+
+    def add(self, region: str):
+        self._counts[region] += 1
+
+
+class RegionPredictor:
+    """Predict the egress region of a proxy from its ingress region.
+
+    An ingress region predicts the egress region only while every proxy of it
+    probed so far exited in the same region, so relayed proxies, e.g. all
+    entering through one HK transit, are never predicted.
+    """
+
+    def __init__(self) -> None:
+        self._direct: dict[str, bool] = {}
+        '''key: ingress region, value: whether its proxies exit in it'''
+
+    def observe(self, ingress: str, egress: str):
+        self._direct[ingress] = self._direct.get(ingress, True) and ingress == egress
+
+    def predict(self, ingress: str) -> str:
+        """Predicted egress region, empty if unknown."""
+        return ingress if ingress and self._direct.get(ingress, False) else ''
+
+
+@dataclass
+class ProbeOptions:
+    """Options of the connectivity and egress filters."""
+
+    ping_timeout: TimeoutPolicy = field(
+        default_factory=lambda: TimeoutPolicy(0.3, 2.0)
+    )
+    egress_timeout: TimeoutPolicy = field(
+        default_factory=lambda: TimeoutPolicy(2.0, 10.0)
+    )
+    region_quota: int = 0
+    '''keep at most this many healthy proxies per egress region, 0 for unlimited'''
+    concurrency: int = 0
+    '''maximum concurrent pings shared by all targets, 0 for unlimited'''
+    targets: dict[str, str] = field(
+        default_factory=lambda: {'gstatic': 'http://www.gstatic.com/generate_204'}
+    )
+    '''key: target name, value: URL, every proxy is pinged against each one'''
+    required_targets: tuple[str, ...] = ()
+    '''targets a proxy must reach to be accepted, the first target if empty'''
+
+    @property
+    def required(self) -> tuple[str, ...]:
+        return self.required_targets or (next(iter(self.targets)),)
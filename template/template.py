@@ -1,13 +1,12 @@
 import copy
 import logging
 import os
-
-import maxminddb
-import yaml
+from typing import TextIO
 
 import config
 import utils.logging
-from subscription.subscription import Subscription
+from template.utils.proxyprovider import ProxyProviderWriter
+from template.utils.ruleprovider import parse_rule, write_rule
 from template.utils.subscriptionadapter import SubscriptionAdapter
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
@@ -19,20 +18,32 @@ class Template:
         self.id = os.path.basename(path).split('.')[0]
         self._logger = utils.logging.IDAdapter(logger, {'id': self.id})
 
-    def fit(self, subscriptions_: list[Subscription], maximind_db_path: str) -> dict:
-        """Fit subscriptions into template."""
-        reader = maxminddb.open_database(maximind_db_path)
-        subscriptions = dict(
-            (subscription.name, SubscriptionAdapter(subscription, reader))
-            for subscription in subscriptions_
-        )
+    def fit(
+        self,
+        subscriptions: dict[str, SubscriptionAdapter],
+        proxy_providers: ProxyProviderWriter | None = None,
+    ) -> dict:
+        """Fit subscriptions into template.
+
+        Args
+        ---
+        subscriptions: key: subscription name, value: adapted subscription
+        proxy_providers: reference the written providers through `use`
+            instead of inlining proxies
+        """
+        import yaml
+
+        # libyaml is an order of magnitude faster on templates with large rule sets
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
         with open(self.path, 'r', encoding='utf-8') as fs:
-            conf = yaml.safe_load(fs)
+            conf = yaml.load(fs, Loader=loader)
 
         if 'proxies' not in conf:
             conf['proxies'] = []
-        for subscription in subscriptions.values():
-            conf['proxies'].extend(subscription.proxies)
+        if proxy_providers is None:
+            for subscription in subscriptions.values():
+                conf['proxies'].extend(subscription.proxies)
+        used_providers: set[str] = set()
 
         for group in conf['proxy-groups']:
             if 'region' in group:
@@ -40,6 +51,10 @@ class Template:
                 del group['region']
             else:
                 region = 'ALL'
+            # Connectivity probe targets the proxies must reach
+            targets = group.pop('targets', [])
+            if isinstance(targets, str):
+                targets = [targets]
             if 'proxies' not in group:
                 group['proxies'] = []
             if 'subscriptions' in group:
@@ -51,42 +66,53 @@ class Template:
                             group['name'],
                         )
                         continue
-                    proxies = subscriptions[name][region]
+                    if proxy_providers is not None:
+                        names = proxy_providers.select(name, region, targets)
+                        group.setdefault('use', []).extend(names)
+                        used_providers.update(names)
+                        continue
+                    proxies = subscriptions[name].select(region, targets)
                     group['proxies'].extend([proxy['name'] for proxy in proxies])
                 del group['subscriptions']
 
+        if used_providers:
+            conf.setdefault('proxy-providers', {}).update(
+                (name, proxy_providers.providers[name])
+                for name in sorted(used_providers)
+            )
+
         return self.clean(conf)
 
     @staticmethod
     def clean(conf_: dict):
-        """Clean config."""
+        """Clean config.
+
+        Rules are filtered lazily, `conf['rules']` becomes an iterator.
+        """
 
         def is_valid_group(group):
             '''Simple validation, not comprehensive.'''
             if 'use' in group or 'proxies' in group:
                 return True
 
-        def clean_groups(conf: dict, last: None | dict = None):
-            if last == conf:
+        def clean_groups(conf: dict, last: None | list = None):
+            if last == conf['proxy-groups']:
                 return conf
-            last = copy.deepcopy(conf)
+            last = copy.deepcopy(conf['proxy-groups'])
             proxies = conf['proxies']
-            proxy_names = [proxy['name'] for proxy in proxies] + [
-                'DIRECT',
-                'REJECT',
-            ]
+            proxy_names = set(proxy['name'] for proxy in proxies)
+            proxy_names.update(('DIRECT', 'REJECT'))
 
             # delete empty groups
             conf['proxy-groups'] = list(filter(is_valid_group, conf['proxy-groups']))
 
-            group_names = [group['name'] for group in conf['proxy-groups']]
-            proxy_names.extend(group_names)
+            proxy_names.update(group['name'] for group in conf['proxy-groups'])
 
             # delete invalid proxies for each group
             for group in conf['proxy-groups']:
                 if 'proxies' in group:
                     group['proxies'] = list(
-                        filter(lambda x: x in proxy_names, group['proxies'])
+                        filter(proxy_names.__contains__, group['proxies'])
                     )
 
             # delete invalid keys for each group
@@ -100,13 +126,38 @@ class Template:
         conf = clean_groups(conf_)
 
         # clean rules
-        group_names = [group['name'] for group in conf['proxy-groups']]
-        group_names.extend(['DIRECT', 'REJECT'])
+        group_names = set(group['name'] for group in conf['proxy-groups'])
+        group_names.update(('DIRECT', 'REJECT'))
 
         def is_valid_rule(rule: str):
-            group = rule.split(',')[-1]
-            return group in group_names
+            return parse_rule(rule)[0] in group_names
+
+        conf['rules'] = filter(is_valid_rule, conf.get('rules', []))
 
-        conf['rules'] = list(filter(is_valid_rule, conf['rules']))
+        return conf
 
-        return clean_groups(conf_)
+    @staticmethod
+    def dump(conf: dict, fs: TextIO):
+        """Dump config as YAML, streaming the rules out one by one.
+
+        Rule providers are dumped after the rules, which may fill them lazily.
+        """
+        import yaml
+
+        rules = conf.get('rules', [])
+        yaml.safe_dump(
+            dict(
+                (k, v)
+                for k, v in conf.items()
+                if k not in ('rules', 'rule-providers')
+            ),
+            fs,
+            allow_unicode=True,
+        )
+        fs.write('rules:\n')
+        for rule in rules:
+            write_rule(fs, rule)
+        if conf.get('rule-providers'):
+            yaml.safe_dump(
+                {'rule-providers': conf['rule-providers']}, fs, allow_unicode=True
+            )
@@ -0,0 +1,22 @@
+"""Config shared by the rule-provider and proxy-provider writers."""
+import os
+
+
+def provider_source(directory: str, name: str, url_prefix='', interval=3600):
+    """Where clash loads a provider file `<directory>/<name>.yaml` from.
+
+    Args
+    ---
+    directory: where provider files are written, next to the output configs
+    url_prefix: serve providers from `<url_prefix>/<file>` instead of local files
+    interval: seconds between updates of a served provider
+    """
+    filename = f'{name}.yaml'
+    source = {'path': f'./{os.path.basename(directory)}/{filename}'}
+    if url_prefix:
+        source.update(
+            type='http', url=f'{url_prefix.rstrip("/")}/{filename}', interval=interval
+        )
+    else:
+        source['type'] = 'file'
+    return source
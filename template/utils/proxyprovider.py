@@ -0,0 +1,69 @@
+"""Write accepted proxies once as proxy-provider files shared by templates."""
+import logging
+import os
+from typing import Iterable
+
+import config
+from template.utils.provider import provider_source
+from template.utils.subscriptionadapter import SubscriptionAdapter
+
+logger = logging.getLogger(config.APP_NAME).getChild(__name__)
+
+
+class ProxyProviderWriter:
+    """Write one proxy provider per subscription, region and reached targets.
+
+    Splitting by region lets templates select regions by picking providers,
+    so every proxy is serialized exactly once however many templates use it.
+    Targets reached by every proxy of a subscription do not split providers.
+    """
+
+    def __init__(self, directory: str, url_prefix='') -> None:
+        """
+        Args
+        ---
+        directory, url_prefix: see `provider_source`
+        """
+        self._directory = directory
+        self._url_prefix = url_prefix
+        self._partitions: dict[str, dict[tuple[str, frozenset[str]], str]] = {}
+        '''key: subscription name, value: {(region, targets): provider name}'''
+        self.providers: dict[str, dict] = {}
+        '''key: provider name, value: provider config'''
+
+    def write(self, subscriptions: dict[str, SubscriptionAdapter]):
+        """Write the provider files of all subscriptions."""
+        import yaml
+
+        os.makedirs(self._directory, exist_ok=True)
+        for subscription_name, subscription in subscriptions.items():
+            names = self._partitions.setdefault(subscription_name, {})
+            partition = subscription.partition()
+            reached = [targets for _, targets in partition]
+            common = frozenset.intersection(*reached) if reached else frozenset()
+            for (region, targets), proxies in partition.items():
+                name = '-'.join(
+                    [subscription_name, region or 'UNKNOWN', *sorted(targets - common)]
+                )
+                path = os.path.join(self._directory, f'{name}.yaml')
+                with open(path, 'w', encoding='utf-8') as fs:
+                    yaml.safe_dump({'proxies': proxies}, fs, allow_unicode=True)
+                names[region, targets] = name
+                self.providers[name] = provider_source(
+                    self._directory, name, self._url_prefix
+                )
+                logger.debug('Wrote proxy provider %s', path)
+
+    def select(
+        self, subscription_name: str, region_key: str, targets: Iterable[str] = ()
+    ) -> list[str]:
+        """Names of the providers of a subscription matching a region key and
+        whose proxies reach all `targets`.
+        """
+        partitions = self._partitions.get(subscription_name, {})
+        return [
+            name
+            for (region, reached), name in partitions.items()
+            if SubscriptionAdapter.match_region(region_key, region)
+            and reached.issuperset(targets)
+        ]
@@ -0,0 +1,121 @@
+"""Move large rule blocks out into shared rule-provider files."""
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Iterable, Iterator, TextIO
+
+import config
+from template.utils.provider import provider_source
+
+logger = logging.getLogger(config.APP_NAME).getChild(__name__)
+
+_LOGIC_RULES = ('AND', 'OR', 'NOT')
+_UNPROVIDABLE_RULES = ('MATCH', 'RULE-SET', 'SCRIPT') + _LOGIC_RULES
+_PLAIN_RULE = re.compile(r'^[A-Za-z][\w.,/+\-@*]*$')
+
+
+def parse_rule(rule: str) -> tuple[str, str]:
+    """Split a rule into its target and classical rule-provider payload.
+
+    Return
+    ---
+    (target, payload), payload is empty if the rule can not be moved into a
+    rule provider.
+    """
+    parts = rule.split(',')
+    type_ = parts[0].strip().upper()
+    if type_ in _LOGIC_RULES:
+        # Commas are nested in the conditions, the target is the last part
+        return parts[-1].strip(), ''
+    if type_ == 'MATCH' or len(parts) < 3:
+        return parts[-1].strip(), ''
+    # e.g. 'IP-CIDR,1.1.1.1/32,PROXY,no-resolve'
+    target = parts[2].strip()
+    if type_ in _UNPROVIDABLE_RULES:
+        return target, ''
+    return target, ','.join(parts[:2] + parts[3:])
+
+
+def write_rule(fs: TextIO, rule: str):
+    """Write a rule as a YAML list item, without building a YAML document."""
+    if ',' in rule and _PLAIN_RULE.match(rule):
+        fs.write(f'- {rule}\n')
+    else:
+        # JSON strings are valid YAML double-quoted scalars
+        fs.write(f'- {json.dumps(rule, ensure_ascii=False)}\n')
+
+
+class RuleProviderWriter:
+    """Replace runs of rules with the same target by `RULE-SET` rules.
+
+    Provider files are named after their content, so a block shared by
+    several templates is written once and referenced from each of them.
+    """
+
+    def __init__(self, directory: str, min_rules: int, url_prefix='') -> None:
+        """
+        Args
+        ---
+        min_rules: runs shorter than this stay inline
+        directory, url_prefix: see `provider_source`
+        """
+        self._directory = directory
+        self._min_rules = min_rules
+        self._url_prefix = url_prefix
+        self._written: set[str] = set()
+
+    def _write(self, payload: list[str]) -> str:
+        """Write a provider file if not written yet, return the provider name."""
+        hasher = hashlib.sha1()
+        for entry in payload:
+            hasher.update(entry.encode('utf-8'))
+            hasher.update(b'\n')
+        name = f'rules-{hasher.hexdigest()[:12]}'
+        if name not in self._written:
+            os.makedirs(self._directory, exist_ok=True)
+            path = os.path.join(self._directory, f'{name}.yaml')
+            with open(path, 'w', encoding='utf-8') as fs:
+                fs.write('payload:\n')
+                for entry in payload:
+                    write_rule(fs, entry)
+            self._written.add(name)
+            logger.debug('Wrote rule provider %s with %d rules', path, len(payload))
+        return name
+
+    def _extract(self, rules: Iterable[str], providers: dict) -> Iterator[str]:
+        run_target = ''
+        run: list[tuple[str, str]] = []
+        for rule in rules:
+            target, payload = parse_rule(rule)
+            if run and (not payload or target != run_target):
+                yield from self._flush(run_target, run, providers)
+                run = []
+            if payload:
+                run_target = target
+                run.append((rule, payload))
+            else:
+                yield rule
+        yield from self._flush(run_target, run, providers)
+
+    def _flush(self, target: str, run: list[tuple[str, str]], providers: dict):
+        if not run or len(run) < self._min_rules:
+            yield from (rule for rule, _ in run)
+            return
+        name = self._write([payload for _, payload in run])
+        providers[name] = {
+            'behavior': 'classical',
+            **provider_source(self._directory, name, self._url_prefix, 86400),
+        }
+        yield f'RULE-SET,{name},{target}'
+
+    def apply(self, conf: dict):
+        """Move the large rule blocks of `conf` into rule providers in place.
+
+        Rules are extracted lazily, `conf['rules']` becomes an iterator and
+        `conf['rule-providers']` is filled as it is consumed.
+        """
+        providers = conf.setdefault('rule-providers', {})
+        conf['rules'] = self._extract(conf.get('rules', []), providers)
+        return conf
@@ -2,12 +2,16 @@ import dataclasses
 import json
 import logging
 import re
-
-import maxminddb
+from typing import TYPE_CHECKING, Iterable
 
 import config
 import utils.logging
-from subscription.subscription import Subscription
+from subscription.utils.probe import lookup_region
+
+if TYPE_CHECKING:
+    import maxminddb
+
+    from subscription.subscription import Subscription
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
 
@@ -17,21 +21,33 @@ class _ProxyClass:
     proxy: dict
     ip: str
     region: str
+    targets: frozenset[str]
+    '''connectivity probe targets reached by the proxy'''
 
 
 class SubscriptionAdapter:
-    def __init__(self, subscription: Subscription, reader: maxminddb.Reader) -> None:
+    def __init__(
+        self, subscription: 'Subscription', reader: 'maxminddb.Reader'
+    ) -> None:
         self._logger = utils.logging.IDAdapter(logger, {'id': subscription.name})
         self._proxy_insts: list[_ProxyClass] = []
-        for ip, proxy in subscription.collection.egress.accepted.items():
-            try:
-                region = reader.get(ip)['country']['iso_code']
-            except KeyError:
+        collection = subscription.collection
+        target_ids = dict(
+            (target, set(ids))
+            for target, ids in collection.connectivity.target_ids.items()
+        )
+        for ip, i in collection.egress.accepted_ids.items():
+            region = lookup_region(reader, ip)
+            if not region:
                 self._logger.warning('Failed to get region for %s', ip)
-                region = ''
-            self._proxy_insts.append(_ProxyClass(proxy, ip, region))
+            targets = frozenset(
+                target for target, ids in target_ids.items() if i in ids
+            )
+            self._proxy_insts.append(
+                _ProxyClass(collection.table[i], ip, region, targets)
+            )
 
-        self._logger.debug(str(self))
+        self._logger.debug('%s', self)
 
     def __str__(self):
         d = []
@@ -40,6 +56,7 @@ class SubscriptionAdapter:
                 {
                     'ip': prxoy_inst.ip,
                     'region': prxoy_inst.region,
+                    'targets': sorted(prxoy_inst.targets),
                     'name': prxoy_inst.proxy['name'],
                     'server': prxoy_inst.proxy['server'],
                 }
@@ -50,10 +67,17 @@ class SubscriptionAdapter:
     def proxies(self):
         return [proxy_inst.proxy for proxy_inst in self._proxy_insts]
 
-    def __getitem__(self, key: str):
+    @staticmethod
+    def _parse_region_key(key: str) -> tuple[bool, set[str]]:
+        """Parse a region key.
+
+        Return
+        ---
+        (positive, regions), `(False, set())` for 'ALL'
+        """
         key = key.upper()
         if key == 'ALL':
-            return self.proxies
+            return False, set()
         if not key.startswith(('+', '-')):
             key = '+' + key
         match = re.match(r'^([+-])[A-Z]{2}(\1[A-Z]{2})*', key)
@@ -62,10 +86,47 @@ class SubscriptionAdapter:
         ), 'key should be like "US", "+US", "-US", "-US-AU", "+US+AU"...'
 
         sign = key[0]
-        positive = sign == '+'
-        regions = set(key[1:].split(sign))
-        if positive:
-            proxy_insts = filter(lambda x: x.region in regions, self._proxy_insts)
-        else:
-            proxy_insts = filter(lambda x: x.region not in regions, self._proxy_insts)
-        return [proxy_inst.proxy for proxy_inst in proxy_insts]
+        return sign == '+', set(key[1:].split(sign))
+
+    @staticmethod
+    def match_region(key: str, region: str) -> bool:
+        """Whether `region` is selected by a region key like "+US"."""
+        positive, regions = SubscriptionAdapter._parse_region_key(key)
+        return (region in regions) == positive
+
+    def partition(self) -> dict[tuple[str, frozenset[str]], list[dict]]:
+        """Group proxies by region and reached targets.
+
+        Return
+        ---
+        key: (region, targets), value: list of proxies
+        """
+        partition: dict[tuple[str, frozenset[str]], list[dict]] = {}
+        for proxy_inst in self._proxy_insts:
+            key = (proxy_inst.region, proxy_inst.targets)
+            partition.setdefault(key, []).append(proxy_inst.proxy)
+        return partition
+
+    def select(self, key: str, targets: Iterable[str] = ()):
+        """Proxies matching a region key and reaching all `targets`."""
+        positive, regions = self._parse_region_key(key)
+        return [
+            proxy_inst.proxy
+            for proxy_inst in self._proxy_insts
+            if (proxy_inst.region in regions) == positive
+            and proxy_inst.targets.issuperset(targets)
+        ]
+
+    def __getitem__(self, key: str):
+        return self.select(key)
+
+
+def open_adapters(subscriptions: list['Subscription'], maxmind_db_path: str):
+    """Adapt filtered subscriptions, key: subscription name, value: adapter."""
+    import maxminddb
+
+    reader = maxminddb.open_database(maxmind_db_path)
+    return dict(
+        (subscription.name, SubscriptionAdapter(subscription, reader))
+        for subscription in subscriptions
+    )
@@ -0,0 +1,74 @@
+"""Import-time budget of the entry point."""
+import os
+import statistics
+import subprocess
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded by the network pipeline only, never by -h or an offline render
+HEAVY_MODULES = (
+    'aiohttp',
+    'appdirs',
+    'asyncio',
+    'maxminddb',
+    'requests',
+    'ssl',
+    'unittest.mock',
+    'yaml',
+)
+
+_LOADED = '''
+import contextlib
+import io
+import runpy
+import sys
+sys.argv = ['main.py', '-h']
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        runpy.run_path('main.py', run_name='__main__')
+    except SystemExit:
+        pass
+import subscription.subscription
+import template.template
+import template.utils.proxyprovider
+import template.utils.ruleprovider
+import template.utils.subscriptionadapter
+print(' '.join(name for name in {modules!r} if name in sys.modules))
+'''
+
+
+def _median_wall_time(argv: list[str], runs=7) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+class StartupTest(unittest.TestCase):
+    BUDGET = 0.1
+    '''seconds of `main.py -h` over a bare interpreter'''
+
+    def test_no_heavy_imports(self):
+        """-h and the modules of an offline render leave heavy modules alone."""
+        proc = subprocess.run(
+            [sys.executable, '-c', _LOADED.format(modules=HEAVY_MODULES)],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(proc.stdout.split(), [])
+
+    def test_help_time_budget(self):
+        bare = _median_wall_time([sys.executable, '-c', 'pass'])
+        help_ = _median_wall_time([sys.executable, 'main.py', '-h'])
+        self.assertLess(help_ - bare, self.BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
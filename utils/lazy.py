@@ -0,0 +1,24 @@
+"""Helpers to defer work from import time to first use."""
+
+
+class cached_classproperty:
+    """Class attribute computed by a function of the class on first access.
+
+    The result replaces the descriptor on the class, so later accesses are
+    plain attribute lookups.
+    """
+
+    def __init__(self, func) -> None:
+        self._func = func
+        self._name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    def __get__(self, instance, owner=None):
+        if owner is None:
+            owner = type(instance)
+        value = self._func(owner)
+        setattr(owner, self._name, value)
+        return value
@@ -1,12 +1,21 @@
+import atexit
+import datetime
+import json
 import logging
+import logging.handlers
+import queue
 
 
-def init_logger(name: str, level="WARNING", log_file=""):
+def init_logger(name: str, level="WARNING", log_file="", json_lines=False):
     """Init a logger.
 
+    Records are handed to a queue, formatting and I/O happen in a listener
+    thread so that logging does not block the event loop.
+
     Args
     ---
     level: str, optional - default: 'WARNING', the default level
+    json_lines: bool, optional - default: False, one JSON object per record
     """
     logger = logging.getLogger(name)
     logger.propagate = False
@@ -17,18 +26,35 @@ def init_logger(name: str, level="WARNING", log_file=""):
         return logger
 
     # Otherwise, initialize the logger.
+    formatter_class = JSONFormatter if json_lines else Formatter
     handlers: list[logging.Handler] = [logging.StreamHandler()]
-    handlers[-1].setFormatter(Formatter())
+    handlers[-1].setFormatter(formatter_class())
     handlers[-1].setLevel(level)
     if log_file:
         handlers.append(logging.FileHandler(log_file, mode="a", encoding="utf-8"))
-        handlers[-1].setFormatter(Formatter())
+        handlers[-1].setFormatter(formatter_class())
         handlers[-1].setLevel("WARNING")
-    logger.handlers = handlers
-    logger.setLevel("DEBUG")
+    listener = logging.handlers.QueueListener(
+        queue.SimpleQueue(), *handlers, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    logger.handlers = [QueueHandler(listener.queue)]
+    # Drop records no handler wants before they are built
+    logger.setLevel(min(handler.level for handler in handlers))
     return logger
 
 
+class QueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records unformatted, the listener thread formats them."""
+
+    def prepare(self, record):
+        # The stock `prepare` formats the record on the logging thread and
+        # merges the traceback into `msg`, hiding `exc_info` from
+        # `JSONFormatter`. The queue is in-process, nothing needs pickling.
+        return record
+
+
 class Formatter(logging.Formatter):
     """Custom logging formatter."""
 
@@ -42,29 +68,63 @@ class Formatter(logging.Formatter):
     # Example when having custom keys
     # FORMAT = "%(asctime)s %(name)s %(levelname)s %(localrank)s %(message)s"
     FORMAT = "%(asctime)s %(levelname)s %(message)s"
+    # Used for records logged through `IDAdapter`
+    ID_FORMAT = "%(asctime)s %(levelname)s %(id)s %(message)s"
 
     # Full version:
     # %Y-%m-%d %H:%M:%S,uuu
     DATEFMT = "%m-%d %H:%M:%S"
 
-    FORMATS = {
-        logging.DEBUG: CYAN + FORMAT + RESET,
-        logging.INFO: WHITE + FORMAT + RESET,
-        logging.WARNING: YELLOW + FORMAT + RESET,
-        logging.ERROR: RED + FORMAT + RESET,
-        logging.CRITICAL: BOLD_RED + FORMAT + RESET,
+    COLORS = {
+        logging.DEBUG: CYAN,
+        logging.INFO: WHITE,
+        logging.WARNING: YELLOW,
+        logging.ERROR: RED,
+        logging.CRITICAL: BOLD_RED,
     }
 
-    def format(self, record):
-        # Example when having custom keys
-        # defaults = {'localrank': '\b'}
-        defaults = {}
+    def __init__(self):
+        super().__init__()
+        # key: (level, whether the record has an id)
+        self._formatters = {}
+        for levelno, color in self.COLORS.items():
+            for has_id, fmt in ((False, self.FORMAT), (True, self.ID_FORMAT)):
+                self._formatters[levelno, has_id] = logging.Formatter(
+                    color + fmt + self.RESET, self.DATEFMT
+                )
 
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, self.DATEFMT, defaults=defaults)
+    def format(self, record):
+        key = (record.levelno, hasattr(record, 'id'))
+        formatter = self._formatters.get(key, self._formatters[logging.INFO, key[1]])
         return formatter.format(record)
 
 
+class JSONFormatter(logging.Formatter):
+    """Format a record as a line of JSON."""
+
+    FIELDS = ('id', 'stage', 'proxy')
+    '''custom keys passed through `extra`, `id` is the subscription id'''
+
+    def format(self, record):
+        event = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(
+                timespec='milliseconds'
+            ),
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        for key in self.FIELDS:
+            if hasattr(record, key):
+                event[key] = getattr(record, key)
+        event['message'] = record.getMessage()
+        if record.exc_info:
+            event['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(event, ensure_ascii=False)
+
+
 class IDAdapter(logging.LoggerAdapter):
+    """Attach an id to records, merged with the `extra` of each call."""
+
     def process(self, msg, kwargs):
-        return '%s %s' % (self.extra['id'], msg), kwargs
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return msg, kwargs
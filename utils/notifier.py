@@ -0,0 +1,121 @@
+"""Notify the end of runs."""
+import asyncio
+import collections
+import logging
+from typing import Protocol
+
+import config
+
+logger = logging.getLogger(config.APP_NAME).getChild(__name__)
+
+
+class Backend(Protocol):
+    """Delivers a batch of messages, e.g. to a chat."""
+
+    async def send(self, text: str):
+        ...
+
+    async def close(self):
+        ...
+
+
+class NullNotifier:
+    """Notifier used when no bot is configured, drops every message."""
+
+    def send(self, message: str):
+        pass
+
+    async def flush(self, timeout=10.0):
+        pass
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class Notifier(NullNotifier):
+    """Send messages through a backend in batches, in the background.
+
+    Messages sent within `batch_interval` seconds are joined into one batch of
+    at most `max_length` characters, and batches are at least `min_interval`
+    seconds apart. Longer messages are split on line boundaries, so markup
+    should not span lines. Pending messages are flushed on close.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        batch_interval=1.0,
+        min_interval=1.0,
+        max_length=4096,
+    ) -> None:
+        self._backend = backend
+        self._batch_interval = batch_interval
+        self._min_interval = min_interval
+        self._max_length = max_length
+        self._pending: collections.deque[str] = collections.deque()
+        self._worker: asyncio.Task | None = None
+        self._flushing = asyncio.Event()
+        self._last_sent = 0.0
+
+    def send(self, message: str):
+        """Queue a message, it is sent with the next batch."""
+        if len(message) > self._max_length:
+            # Batches join lines back up to the limit, cutting only too long ones
+            for line in message.split('\n'):
+                if len(line) > self._max_length:
+                    line = line[: self._max_length - 1] + '…'
+                self._pending.append(line)
+        else:
+            self._pending.append(message)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    def _next_batch(self) -> str:
+        batch = self._pending.popleft()
+        while (
+            self._pending
+            and len(batch) + 1 + len(self._pending[0]) <= self._max_length
+        ):
+            batch += '\n' + self._pending.popleft()
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            # Let messages sent close together share a batch
+            await asyncio.wait_for(self._flushing.wait(), self._batch_interval)
+        except asyncio.TimeoutError:
+            pass
+        while self._pending:
+            batch = self._next_batch()
+            delay = self._last_sent + self._min_interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self._backend.send(batch)
+            except Exception:
+                logger.warning('Failed to send notification', exc_info=True)
+            self._last_sent = loop.time()
+
+    async def flush(self, timeout=10.0):
+        """Send the pending messages now, dropping them after `timeout` seconds."""
+        if self._worker is None or self._worker.done():
+            return
+        self._flushing.set()
+        try:
+            await asyncio.wait_for(self._worker, timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Dropped %d pending notifications', len(self._pending))
+            self._pending.clear()
+        finally:
+            self._flushing.clear()
+
+    async def close(self):
+        await self.flush()
+        await self._backend.close()
@@ -0,0 +1,88 @@
+"""Opt-in profiling of runs."""
+import cProfile
+import datetime
+import json
+import logging
+import os
+import tracemalloc
+
+import config
+
+logger = logging.getLogger(config.APP_NAME).getChild(__name__)
+
+
+class NullProfiler:
+    """Profiler used when profiling is disabled, does nothing."""
+
+    def start(self):
+        pass
+
+    def snapshot(self, name: str):
+        pass
+
+    def add_stages(self, id_: str, durations: dict[str, float]):
+        pass
+
+    def stop(self):
+        pass
+
+
+class Profiler(NullProfiler):
+    """Record a cProfile dump, stage wall times and memory snapshots of a run.
+
+    Outputs are written to a new timestamped directory under `directory`:
+    `run.prof`, `stages.json` and `memory-<n>-<name>.txt` if `memory` is set.
+    """
+
+    TOP_STATS = 30
+
+    def __init__(self, directory: str, memory=False) -> None:
+        timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.directory = os.path.join(directory, timestamp)
+        self._memory = memory
+        self._profile = cProfile.Profile()
+        self._stages: dict[str, dict[str, float]] = {}
+        self._snapshots: list[tracemalloc.Snapshot] = []
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self._memory:
+            tracemalloc.start()
+            self.snapshot('start')
+        self._profile.enable()
+
+    def snapshot(self, name: str):
+        """Write the top allocations, and the growth since the last snapshot."""
+        if not self._memory:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        path = os.path.join(
+            self.directory, f'memory-{len(self._snapshots)}-{name}.txt'
+        )
+        with open(path, 'w', encoding='utf-8') as fs:
+            current, peak = tracemalloc.get_traced_memory()
+            fs.write(f'current {current >> 10} KiB, peak {peak >> 10} KiB\n\n')
+            fs.write('top allocations:\n')
+            for stat in snapshot.statistics('lineno')[: self.TOP_STATS]:
+                fs.write(f'{stat}\n')
+            if self._snapshots:
+                fs.write('\ntop growth since last snapshot:\n')
+                diff = snapshot.compare_to(self._snapshots[-1], 'lineno')
+                for stat in diff[: self.TOP_STATS]:
+                    fs.write(f'{stat}\n')
+        self._snapshots.append(snapshot)
+
+    def add_stages(self, id_: str, durations: dict[str, float]):
+        """Record the wall time in seconds of each stage of a subscription."""
+        self._stages[id_] = dict(durations)
+
+    def stop(self):
+        self._profile.disable()
+        self._profile.dump_stats(os.path.join(self.directory, 'run.prof'))
+        with open(
+            os.path.join(self.directory, 'stages.json'), 'w', encoding='utf-8'
+        ) as fs:
+            json.dump(self._stages, fs, indent=4, ensure_ascii=False)
+        if self._memory:
+            tracemalloc.stop()
+        logger.info('Wrote profile to %s', self.directory)
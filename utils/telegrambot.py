@@ -1,53 +1,59 @@
 """Telegram bot module."""
-import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
-
-import requests
 
 import config
 
 logger = logging.getLogger(config.APP_NAME).getChild(__name__)
 
 
-class TelegramBot:
-    """Telegram bot class."""
+class TelegramBackend:
+    """Notifier backend sending messages to a Telegram chat."""
 
-    _HEADERS = {
-        'Content-Type': 'application/json',
-        'Proxy-Authorization': 'Basic base64',
-    }
+    BASE_URL = 'https://api.telegram.org'
     _DATA = {
         'parse_mode': 'HTML',
         'disable_notification': True,
     }
 
-    def __init__(self, api_key, chat_id):
-        self._base_url = f'https://api.telegram.org/bot{api_key}'
-        self._data = self._DATA.copy()
-        self._data['chat_id'] = chat_id
-        self._executor = ThreadPoolExecutor()
-
-    def send_message(self, message, timeout=5):
-        """Send a message to the chat."""
-
-        def _send_message():
-            data = self._data.copy()
-            data['text'] = message
-            data = json.dumps(data)
-            url = f'{self._base_url}/sendMessage'
-            with requests.post(
-                url,
-                data=data,
-                headers=self._HEADERS,
-                timeout=timeout,
-            ) as response:
-                if not response.ok:
-                    logger.debug(
-                        'Failed to send message "%s" to Telegram. Response: %s',
-                        message,
-                        response.text,
-                    )
-                return response
-
-        return self._executor.submit(_send_message)
+    def __init__(self, api_key, chat_id, base_url=BASE_URL, timeout=5.0):
+        """
+        Args
+        ---
+        base_url: bot API server, e.g. a local stand-in for testing
+        timeout: seconds per request
+        """
+        self._url = f'{base_url.rstrip("/")}/bot{api_key}/sendMessage'
+        self._data = self._DATA | {'chat_id': chat_id}
+        self._timeout = timeout
+        self._session = None
+
+    async def send(self, text: str, retries=1):
+        """Send a message to the chat, waiting out the rate limit if hit."""
+        import asyncio
+
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self._timeout), trust_env=True
+            )
+        async with self._session.post(
+            self._url, json=self._data | {'text': text}
+        ) as resp:
+            if resp.status == 429 and retries:
+                body = await resp.json()
+                retry_after = body.get('parameters', {}).get('retry_after', 1)
+                logger.debug('Telegram rate limit hit, retry after %ss', retry_after)
+                await asyncio.sleep(retry_after)
+                return await self.send(text, retries - 1)
+            if resp.status != 200:
+                logger.warning(
+                    'Failed to send message to Telegram, code: %d, text: %s',
+                    resp.status,
+                    await resp.text(),
+                )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None